@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# api_server.py - لایه HTTP: فقط ثبت job در صف پایدار و جواب دادن از دیتابیس
+#
+# تلگرام، yt-dlp و worker ها در worker_service.py اجرا می‌شوند و job ها را
+# با lease و heartbeat از همان صف SQLite برمی‌دارند؛ تعداد هر کدام جدا قابل تغییر است.
+
+import logging
+import os
+
+from fastapi import FastAPI
+
+import backend
+
+logger = logging.getLogger(__name__)
+
+app = FastAPI()
+app.include_router(backend.router)
+
+
+@app.on_event("startup")
+async def startup_event():
+    logger.info("🚀 Starting API server...")
+    await backend.init_database()
+    logger.info("✅ API server is ready!")
+
+
+if __name__ == '__main__':
+    import uvicorn
+    port = int(os.getenv('PORT', 8000))
+    uvicorn.run(app, host='0.0.0.0', port=port)
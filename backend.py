@@ -3,20 +3,37 @@
 
 import os
 import re
+import json
+import random
+import shutil
 import asyncio
+import contextvars
 import aiohttp
 import logging
 import sqlite3
-from pathlib import Path
-from contextlib import contextmanager
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
-from fastapi import FastAPI, HTTPException, Header
+from fastapi import APIRouter, FastAPI, HTTPException, Header, Response
 from pydantic import BaseModel
 from telethon import TelegramClient
+from telethon.errors import FileReferenceExpiredError, FileReferenceInvalidError, FloodWaitError
 from telethon.tl.types import DocumentAttributeFilename, DocumentAttributeVideo
 
+from content_hash import BlockHasher, align_to_blocks
+from media_probe import ProbeService
+import metrics
+from url_keys import KEY_VERSION, canonical_key
+from ytdlp_pool import YtdlpError, YtdlpPool, compact_info, info_size
+from telegram_pool import ClientPool, note_flood_wait, session_names
+from telegram_upload import input_media, media_handle, upload_file, upload_ranges
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -30,30 +47,162 @@ BACKUP_CHANNEL_ID = int(os.getenv('BACKUP_CHANNEL_ID', '0'))
 API_SECRET = 'mmdw'
 
 DOWNLOAD_PATH = '/tmp/downloads'
-DATABASE_PATH = '/data/cache.db'
+DATABASE_PATH = os.getenv('DATABASE_PATH', '/data/cache.db')
+DB_THREADS = int(os.getenv('DB_THREADS', '4'))
+# جستجوی دسته‌ای کش: حداکثر لینک در هر درخواست و تعداد پارامتر در هر کوئری IN
+CACHE_BATCH_MAX = int(os.getenv('CACHE_BATCH_MAX', '1000'))
+CACHE_BATCH_CHUNK = 500
 MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024  # 2GB
 
+# بودجه دیسک پوشه دانلود: job ها قبل از دانلود حجم تخمینی خود را رزرو می‌کنند
+# (رزروها در job_queue هستند و این بودجه بین همه پروسه‌های worker مشترک است)
+DISK_BUDGET = int(os.getenv('DISK_BUDGET', str(8 * 1024 * 1024 * 1024)))
+UNKNOWN_JOB_SIZE = int(os.getenv('UNKNOWN_JOB_SIZE', str(256 * 1024 * 1024)))
+ADMISSION_RETRY_DELAY = float(os.getenv('ADMISSION_RETRY_DELAY', '30'))
+SIZE_ESTIMATE_TIMEOUT = float(os.getenv('SIZE_ESTIMATE_TIMEOUT', '60'))
+# کش info استخراج شده yt-dlp (لینک فرمت‌ها بعد از چند ساعت منقضی می‌شوند)
+EXTRACT_CACHE_TTL = int(os.getenv('EXTRACT_CACHE_TTL', '7200'))
+# yt-dlp ویدیو و صدا را جدا دانلود و بعد merge می‌کند
+YTDLP_DISK_FACTOR = 2
+YTDLP_SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+YTDLP_FORMAT = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+YTDLP_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+COOKIE_PATH = '/app/cookies.txt'
+
+# process های yt-dlp همیشه آماده (0 = اجرای CLI برای هر job)
+YTDLP_WORKERS = int(os.getenv('YTDLP_WORKERS', '2'))
+YTDLP_WORKER_MAX_JOBS = int(os.getenv('YTDLP_WORKER_MAX_JOBS', '50'))
+YTDLP_WORKER_MAX_RSS = int(os.getenv('YTDLP_WORKER_MAX_RSS', str(512 * 1024 * 1024)))
+# ظرفیت جدای استخراج info در مرحله پذیرش (بدون رقابت با دانلودها)
+YTDLP_EXTRACT_WORKERS = int(os.getenv('YTDLP_EXTRACT_WORKERS', '1'))
+
+# همزمانی: تعداد worker ها و ظرفیت هر مرحله
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', '4'))
+DOWNLOAD_SLOTS = int(os.getenv('DOWNLOAD_SLOTS', '2'))
+PROBE_SLOTS = int(os.getenv('PROBE_SLOTS', '2'))
+UPLOAD_SLOTS = int(os.getenv('UPLOAD_SLOTS', '2'))
+
+# صف پایدار: مدت lease، تعداد تلاش و فاصله poll
+LEASE_TIMEOUT = int(os.getenv('LEASE_TIMEOUT', '600'))
+MAX_JOB_ATTEMPTS = int(os.getenv('MAX_JOB_ATTEMPTS', '3'))
+QUEUE_POLL_INTERVAL = float(os.getenv('QUEUE_POLL_INTERVAL', '2'))
+JOB_RETENTION_DAYS = int(os.getenv('JOB_RETENTION_DAYS', '7'))
+CACHE_HIT_PRIORITY = os.getenv('CACHE_HIT_PRIORITY', '1') == '1'
+# فاصله ذخیره پیشرفت job در جدول و بررسی درخواست لغو
+JOB_STATUS_INTERVAL = float(os.getenv('JOB_STATUS_INTERVAL', '2'))
+# فاصله انتشار وضعیت پروسه worker در دیتابیس؛ بعد از سه دوره بدون به‌روزرسانی مرده حساب می‌شود
+WORKER_STATUS_INTERVAL = float(os.getenv('WORKER_STATUS_INTERVAL', '5'))
+WORKER_NAME = f"{socket.gethostname()}:{os.getpid()}"
+# job منتظر لینکی که در حال دانلود است بدون اشغال worker به صف برمی‌گردد؛ پایان دانلود
+# آن را زودتر بیدار می‌کند و این تاخیر فقط برای وقتی است که job اصلی از بین رفته باشد
+FLIGHT_WAIT_DELAY = float(os.getenv('FLIGHT_WAIT_DELAY', '30'))
+# آدرس worker_service برای بیدار کردن فوری بعد از ثبت job (حالت API و worker جدا)
+WORKER_URL = os.getenv('WORKER_URL', '')
+
+# استریم لینک‌های مستقیم به تلگرام بدون ذخیره روی دیسک
+DIRECT_STREAMING = os.getenv('DIRECT_STREAMING', '1') == '1'
+STREAM_MIN_SIZE = int(os.getenv('STREAM_MIN_SIZE', str(20 * 1024 * 1024)))
+STREAM_BUFFER_PARTS = int(os.getenv('STREAM_BUFFER_PARTS', '16'))
+
+# دانلود چند اتصالی (Range) برای لینک‌های مستقیم
+DOWNLOAD_CONNECTIONS = int(os.getenv('DOWNLOAD_CONNECTIONS', '4'))
+MIN_SEGMENT_SIZE = int(os.getenv('MIN_SEGMENT_SIZE', str(8 * 1024 * 1024)))
+SEGMENT_RETRIES = int(os.getenv('SEGMENT_RETRIES', '3'))
+
+# تلاش دوباره دانلود (ادامه از بایت‌های دریافت شده) با backoff نمایی
+DOWNLOAD_RETRIES = int(os.getenv('DOWNLOAD_RETRIES', '3'))
+RETRY_BACKOFF_BASE = float(os.getenv('RETRY_BACKOFF_BASE', '2'))
+RETRY_BACKOFF_MAX = float(os.getenv('RETRY_BACKOFF_MAX', '60'))
+# خطاهای yt-dlp که با تلاش دوباره درست نمی‌شوند
+YTDLP_PERMANENT_ERRORS = (
+    'Unsupported URL', 'Video unavailable', 'Private video',
+    'HTTP Error 404', 'Sign in to confirm', 'is not available'
+)
+
+# آپلود موازی part ها به تلگرام
+UPLOAD_CONNECTIONS = int(os.getenv('UPLOAD_CONNECTIONS', '4'))
+UPLOAD_PARALLEL = int(os.getenv('UPLOAD_PARALLEL', '8'))
+UPLOAD_PART_SIZE = int(os.getenv('UPLOAD_PART_SIZE', str(512 * 1024)))
+
+# چند session تلگرام برای همان bot (هر کدام یک اتصال MTProto جدا)
+TELEGRAM_SESSIONS = int(os.getenv('TELEGRAM_SESSIONS', '1'))
+# هر پروسه worker باید فایل session جدا داشته باشد (فایل session یک دیتابیس SQLite است)
+TELEGRAM_SESSION = os.getenv('TELEGRAM_SESSION', 'bot_session')
+
 # Global Variables
-client = None
-job_queue = asyncio.Queue()
+job_available = asyncio.Event()
+worker_tasks = []
+background_tasks = []
+active_jobs = {}
+# job های در حال اجرای همین پروسه (برای لغو فوری) و پیشرفت لحظه‌ای آن‌ها
+running_jobs = {}
+cancelled_jobs = set()
+# job هایی که lease آن‌ها وسط کار از دست رفت (نتیجه‌شان ثبت نمی‌شود)
+lost_leases = set()
+job_progress = {}
+current_job_id = contextvars.ContextVar('current_job_id', default=None)
+# شمارنده‌های hit / miss کش (از زمان شروع سرویس)
+cache_stats = {'hits': 0, 'misses': 0}
+# endpoint ها روی router هستند تا api_server.py هم بدون startup این فایل از آن‌ها استفاده کند
 app = FastAPI()
+router = APIRouter()
 
 # ===========================
 # Database
 # ===========================
-@contextmanager
-def get_db():
-    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-    finally:
-        conn.close()
+class Database:
+    """
+    دسترسی به SQLite خارج از event loop
+    - کوئری‌ها روی thread های اختصاصی اجرا می‌شوند و loop هرگز بلاک نمی‌شود
+    - هر thread یک اتصال دائمی در حالت WAL دارد
+    - statement های تکراری در cache همان اتصال آماده (prepared) می‌مانند
+    """
+    
+    def __init__(self, path, threads=DB_THREADS):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='sqlite')
+        self._local = threading.local()
+    
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+    
+    def _call(self, fn):
+        conn = self._connection()
+        try:
+            result = fn(conn)
+            conn.commit()
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+    
+    async def run(self, fn):
+        """اجرای fn(conn) روی thread دیتابیس داخل یک تراکنش"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn)
+    
+    async def execute(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params))
+    
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+    
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+db = Database(DATABASE_PATH)
 
-def init_database():
+async def init_database():
     os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
     
-    with get_db() as conn:
+    def create_schema(conn):
         conn.execute('''
             CREATE TABLE IF NOT EXISTS file_cache (
                 url TEXT PRIMARY KEY,
@@ -81,91 +230,738 @@ def init_database():
             ON user_history(user_id, timestamp DESC)
         ''')
         
-        conn.commit()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS job_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker_id TEXT,
+                lease_expires_at REAL,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                available_at REAL NOT NULL DEFAULT 0,
+                user_id INTEGER,
+                vtime REAL NOT NULL DEFAULT 0,
+                priority INTEGER NOT NULL DEFAULT 0,
+                stage TEXT,
+                bytes_done INTEGER,
+                bytes_total INTEGER,
+                stage_started_at REAL,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                flight_key TEXT,
+                disk_reserved INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_job_queue_state 
+            ON job_queue(state, id)
+        ''')
+        
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_job_queue_lease 
+            ON job_queue(state, lease_expires_at)
+        ''')
+        
+        queue_columns = {row['name'] for row in conn.execute('PRAGMA table_info(job_queue)')}
+        for name, column_type in (
+            ('available_at', 'REAL NOT NULL DEFAULT 0'),
+            ('user_id', 'INTEGER'),
+            ('vtime', 'REAL NOT NULL DEFAULT 0'),
+            ('priority', 'INTEGER NOT NULL DEFAULT 0'),
+            ('stage', 'TEXT'),
+            ('bytes_done', 'INTEGER'),
+            ('bytes_total', 'INTEGER'),
+            ('stage_started_at', 'REAL'),
+            ('cancel_requested', 'INTEGER NOT NULL DEFAULT 0'),
+            ('flight_key', 'TEXT'),
+            ('disk_reserved', 'INTEGER NOT NULL DEFAULT 0'),
+        ):
+            if name not in queue_columns:
+                conn.execute(f'ALTER TABLE job_queue ADD COLUMN {name} {column_type}')
+        
+        # ترتیب سرویس: اولویت (hit کش)، سپس زمان مجازی fair queuing
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_job_queue_fair 
+            ON job_queue(state, priority DESC, vtime, id)
+        ''')
+        
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_job_queue_user 
+            ON job_queue(user_id, state, vtime)
+        ''')
+        
+        # single-flight: job lease شده با flight_key دانلود آن لینک را بر عهده دارد،
+        # job در صف با flight_key منتظر همان دانلود است
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_job_queue_flight 
+            ON job_queue(flight_key, state)
+        ''')
+        
+        # ستون‌های اضافه شده بعد از نسخه اول جدول file_cache
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(file_cache)')}
+        for name, column_type in (
+            ('doc_id', 'INTEGER'),
+            ('access_hash', 'INTEGER'),
+            ('file_reference', 'BLOB'),
+            ('content_hash', 'TEXT'),
+        ):
+            if name not in columns:
+                conn.execute(f'ALTER TABLE file_cache ADD COLUMN {name} {column_type}')
+        
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_file_cache_file_id 
+            ON file_cache(file_id)
+        ''')
+        
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_file_cache_content_hash 
+            ON file_cache(content_hash)
+        ''')
+        
+        # info استخراج شده yt-dlp با کلید canonical (جدا از file_cache چون TTL دارد)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS extract_cache (
+                url TEXT PRIMARY KEY,
+                info TEXT NOT NULL,
+                file_size INTEGER,
+                duration INTEGER,
+                width INTEGER,
+                height INTEGER,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_extract_cache_expires 
+            ON extract_cache(expires_at)
+        ''')
+        
+        # وضعیت هر پروسه worker (api_server.py خودش worker ندارد و /stats را از اینجا می‌خواند)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS worker_status (
+                worker TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < KEY_VERSION:
+            rekey_file_cache(conn)
+            conn.execute(f'PRAGMA user_version = {KEY_VERSION}')
     
+    await db.run(create_schema)
     logger.info("✅ Database initialized")
 
+def rekey_file_cache(conn):
+    """
+    مهاجرت ردیف‌های کش به کلید canonical
+    - اگر چند لینک به یک کلید برسند، جدیدترین ردیف می‌ماند
+    """
+    rows = conn.execute(
+        'SELECT url, created_at FROM file_cache ORDER BY created_at, rowid'
+    ).fetchall()
+    moved = 0
+    for row in rows:
+        key = canonical_key(row['url'])
+        if key == row['url']:
+            continue
+        
+        existing = conn.execute(
+            'SELECT created_at FROM file_cache WHERE url = ?', (key,)
+        ).fetchone()
+        if existing and existing['created_at'] >= row['created_at']:
+            conn.execute('DELETE FROM file_cache WHERE url = ?', (row['url'],))
+        else:
+            conn.execute('UPDATE OR REPLACE file_cache SET url = ? WHERE url = ?', (key, row['url']))
+        moved += 1
+    
+    if moved:
+        logger.info(f"🔑 Rekeyed {moved} cache entries")
+
 # ===========================
 # Cache Functions
 # ===========================
 async def get_cached_file(url):
-    with get_db() as conn:
-        result = conn.execute(
-            'SELECT * FROM file_cache WHERE url = ?', 
-            (url,)
-        ).fetchone()
-        
-        if result:
-            return {
-                'file_id': result['file_id'],
-                'file_type': result['file_type'],
-                'filename': result['filename'],
-                'file_size': result['file_size']
+    result = await db.fetchone(
+        'SELECT * FROM file_cache WHERE url = ?', 
+        (canonical_key(url),)
+    )
+    
+    cache_stats['hits' if result else 'misses'] += 1
+    metrics.CACHE_LOOKUPS.labels(detect_url_type(url), 'hit' if result else 'miss').inc()
+    if result:
+        return {
+            'file_id': result['file_id'],
+            'file_type': result['file_type'],
+            'filename': result['filename'],
+            'file_size': result['file_size'],
+            'handle': row_media_handle(result)
+        }
+    return None
+
+async def get_cached_files(urls):
+    """
+    جستجوی دسته‌ای کش: یک کوئری IN روی کلید اصلی برای همه لینک‌ها
+    خروجی: {url: cached} فقط برای لینک‌های موجود در کش
+    """
+    candidates = {url: canonical_key(url) for url in urls}
+    keys = list(set(candidates.values()))
+    
+    rows = {}
+    for start in range(0, len(keys), CACHE_BATCH_CHUNK):
+        chunk = keys[start:start + CACHE_BATCH_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        for row in await db.fetchall(
+            f'SELECT * FROM file_cache WHERE url IN ({placeholders})', chunk
+        ):
+            rows[row['url']] = row
+    
+    hits = {}
+    for url, key in candidates.items():
+        row = rows.get(key)
+        metrics.CACHE_LOOKUPS.labels(detect_url_type(url), 'hit' if row else 'miss').inc()
+        if row:
+            hits[url] = {
+                'file_id': row['file_id'],
+                'file_type': row['file_type'],
+                'filename': row['filename'],
+                'file_size': row['file_size']
             }
+    cache_stats['hits'] += len(hits)
+    cache_stats['misses'] += len(candidates) - len(hits)
+    return hits
+
+def row_media_handle(row):
+    """handle سند تلگرام ذخیره شده در ردیف کش (اگر باشد)"""
+    if row['doc_id'] is None:
+        return None
+    return {
+        'doc_id': row['doc_id'],
+        'access_hash': row['access_hash'],
+        'file_reference': row['file_reference']
+    }
+
+async def is_cached(url):
+    """فقط وجود در کش (بدون شمارش hit / miss)"""
+    row = await db.fetchone(
+        'SELECT 1 FROM file_cache WHERE url = ?', (canonical_key(url),)
+    )
+    return row is not None
+
+async def get_cached_by_content(content_hash, file_size):
+    """پیام پشتیبانی که دقیقا همین محتوا را دارد (از هر لینکی)"""
+    result = await db.fetchone(
+        'SELECT * FROM file_cache WHERE content_hash = ? AND file_size = ? LIMIT 1',
+        (content_hash, file_size)
+    )
+    if result:
+        return {
+            'file_id': result['file_id'],
+            'file_type': result['file_type'],
+            'filename': result['filename'],
+            'file_size': result['file_size'],
+            'handle': row_media_handle(result)
+        }
     return None
 
-async def save_to_cache(url, file_id, file_type, filename, file_size):
-    with get_db() as conn:
-        conn.execute('''
-            INSERT OR REPLACE INTO file_cache 
-            (url, file_id, file_type, filename, file_size) 
-            VALUES (?, ?, ?, ?, ?)
-        ''', (url, file_id, file_type, filename, file_size))
-        conn.commit()
+async def save_to_cache(url, file_id, file_type, filename, file_size, handle=None, content_hash=None):
+    handle = handle or {}
+    await db.execute('''
+        INSERT OR REPLACE INTO file_cache 
+        (url, file_id, file_type, filename, file_size, doc_id, access_hash, file_reference, content_hash) 
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        canonical_key(url), file_id, file_type, filename, file_size,
+        handle.get('doc_id'), handle.get('access_hash'), handle.get('file_reference'),
+        content_hash
+    ))
     
     logger.info(f"💾 Cached: {filename}")
 
+async def get_extract_info(url):
+    """info استخراج شده yt-dlp که هنوز منقضی نشده"""
+    row = await db.fetchone(
+        'SELECT info FROM extract_cache WHERE url = ? AND expires_at > ?',
+        (canonical_key(url), time.time())
+    )
+    metrics.EXTRACT_CACHE_LOOKUPS.labels('hit' if row else 'miss').inc()
+    return json.loads(row['info']) if row else None
+
+async def save_extract_info(url, info):
+    now = time.time()
+    await db.execute('''
+        INSERT OR REPLACE INTO extract_cache 
+        (url, info, file_size, duration, width, height, created_at, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        canonical_key(url), json.dumps(info), info_size(info),
+        info.get('duration'), info.get('width'), info.get('height'),
+        now, now + EXTRACT_CACHE_TTL
+    ))
+
+async def drop_extract_info(url):
+    await db.execute('DELETE FROM extract_cache WHERE url = ?', (canonical_key(url),))
+
+async def purge_extract_cache():
+    await db.execute('DELETE FROM extract_cache WHERE expires_at <= ?', (time.time(),))
+
 async def add_to_user_history(user_id, url, filename, file_size):
-    with get_db() as conn:
+    await db.execute('''
+        INSERT INTO user_history (user_id, url, filename, file_size)
+        VALUES (?, ?, ?, ?)
+    ''', (user_id, url, filename, file_size))
+
+# ===========================
+# Durable Job Queue
+# ===========================
+# وضعیت‌ها: queued → leased → done / failed / cancelled
+async def enqueue_job(job, priority=0):
+    """
+    افزودن job به صف با زمان مجازی fair queuing
+    - هر کاربر زیرصف خودش را دارد؛ job اول کاربر از زمان مجازی فعلی صف شروع می‌کند
+      و job های بعدی‌اش یکی یکی عقب‌تر می‌روند، پس کاربرها نوبتی سرویس می‌گیرند
+    - job های با priority بالاتر (مثلا hit کش) قبل از بقیه برداشته می‌شوند
+    خروجی: جایگاه واقعی job در ترتیب سرویس
+    """
+    now = time.time()
+    
+    def insert(conn):
+        # زمان مجازی صف = کوچکترین tag در انتظار (در صف خالی مقدار مهم نیست)
+        system_vtime = conn.execute('''
+            SELECT COALESCE(MIN(vtime), 0) FROM job_queue WHERE state = 'queued'
+        ''').fetchone()[0]
+        user_vtime = conn.execute('''
+            SELECT MAX(vtime) FROM job_queue WHERE user_id = ? AND state = 'queued'
+        ''', (job['user_id'],)).fetchone()[0]
+        vtime = system_vtime if user_vtime is None else max(system_vtime, user_vtime + 1)
+        
+        cursor = conn.execute('''
+            INSERT INTO job_queue 
+            (job_id, payload, state, created_at, updated_at, user_id, vtime, priority)
+            VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)
+        ''', (job['job_id'], json.dumps(job), now, now, job['user_id'], vtime, priority))
+        
+        return conn.execute('''
+            SELECT COUNT(*) AS count FROM job_queue 
+            WHERE state = 'queued' AND (
+                priority > ? OR (priority = ? AND (vtime < ? OR (vtime = ? AND id <= ?)))
+            )
+        ''', (priority, priority, vtime, vtime, cursor.lastrowid)).fetchone()
+    
+    position = await db.run(insert)
+    job_available.set()
+    return position['count']
+
+async def lease_job(worker_id):
+    """گرفتن job بعدی (اولویت، زمان مجازی، ترتیب ورود) با lease محدود"""
+    now = time.time()
+    row = await db.fetchone('''
+        UPDATE job_queue 
+        SET state = 'leased', worker_id = ?, attempts = attempts + 1,
+            lease_expires_at = ?, updated_at = ?, flight_key = NULL, disk_reserved = 0
+        WHERE id = (
+            SELECT id FROM job_queue 
+            WHERE state = 'queued' AND available_at <= ? 
+            ORDER BY priority DESC, vtime, id LIMIT 1
+        ) AND state = 'queued'
+        RETURNING job_id, payload, attempts, created_at
+    ''', (worker_id, now + LEASE_TIMEOUT, now, now))
+    
+    if not row:
+        return None
+    
+    job = json.loads(row['payload'])
+    job['attempts'] = row['attempts']
+    if row['attempts'] == 1:
+        metrics.QUEUE_WAIT.labels(detect_url_type(job['url'])).observe(now - row['created_at'])
+    return job
+
+async def renew_lease(job_id, worker_id, progress=None):
+    """
+    تمدید lease و ذخیره پیشرفت job
+    خروجی: True اگر برای job درخواست لغو ثبت شده باشد (None اگر lease از دست رفته)
+    """
+    now = time.time()
+    progress = progress or {}
+    row = await db.fetchone('''
+        UPDATE job_queue 
+        SET lease_expires_at = ?, updated_at = ?, stage = COALESCE(?, stage),
+            bytes_done = ?, bytes_total = ?, stage_started_at = COALESCE(?, stage_started_at)
+        WHERE job_id = ? AND worker_id = ? AND state = 'leased'
+        RETURNING cancel_requested
+    ''', (
+        now + LEASE_TIMEOUT, now, progress.get('stage'),
+        progress.get('done'), progress.get('total'), progress.get('started_at'),
+        job_id, worker_id
+    ))
+    return bool(row['cancel_requested']) if row else None
+
+async def finish_job(job_id, worker_id, state='done', error=None):
+    """
+    ثبت نتیجه job فقط اگر lease هنوز مال همین worker باشد
+    خروجی: False اگر lease منقضی شده و job به worker دیگری رسیده باشد
+    """
+    cursor = await db.execute('''
+        UPDATE job_queue 
+        SET state = ?, error = ?, lease_expires_at = NULL, updated_at = ?, disk_reserved = 0
+        WHERE job_id = ? AND worker_id = ? AND state = 'leased'
+    ''', (state, error, time.time(), job_id, worker_id))
+    if not cursor.rowcount:
+        logger.warning(f"⚠️ Lease lost for {job_id}, result '{state}' discarded")
+    return cursor.rowcount > 0
+
+async def cancel_job(job_id):
+    """
+    لغو یک job
+    - job در صف همان لحظه لغو می‌شود
+    - job در حال اجرا پرچم cancel_requested می‌گیرد و worker صاحب lease آن را متوقف می‌کند
+    خروجی: وضعیت job بعد از درخواست (None اگر job وجود ندارد)
+    """
+    now = time.time()
+    
+    def cancel(conn):
+        cursor = conn.execute('''
+            UPDATE job_queue 
+            SET state = 'cancelled', error = 'cancelled by user', updated_at = ?
+            WHERE job_id = ? AND state = 'queued'
+        ''', (now, job_id))
+        if cursor.rowcount:
+            return 'cancelled'
+        
+        cursor = conn.execute('''
+            UPDATE job_queue SET cancel_requested = 1, updated_at = ?
+            WHERE job_id = ? AND state = 'leased'
+        ''', (now, job_id))
+        if cursor.rowcount:
+            return 'cancelling'
+        
+        row = conn.execute('SELECT state FROM job_queue WHERE job_id = ?', (job_id,)).fetchone()
+        return row['state'] if row else None
+    
+    return await db.run(cancel)
+
+async def get_job_status(job_id):
+    """وضعیت، مرحله، پیشرفت و زمان باقیمانده تخمینی یک job"""
+    def status(conn):
+        row = conn.execute('''
+            SELECT id, job_id, state, attempts, error, stage, bytes_done, bytes_total,
+                   stage_started_at, cancel_requested, created_at, updated_at, priority, vtime
+            FROM job_queue WHERE job_id = ?
+        ''', (job_id,)).fetchone()
+        if not row:
+            return None
+        
+        result = dict(row)
+        if row['state'] == 'queued':
+            result['queue_position'] = conn.execute('''
+                SELECT COUNT(*) FROM job_queue 
+                WHERE state = 'queued' AND (
+                    priority > ? OR (priority = ? AND (vtime < ? OR (vtime = ? AND id <= ?)))
+                )
+            ''', (row['priority'], row['priority'], row['vtime'], row['vtime'], row['id'])).fetchone()[0]
+        return result
+    
+    result = await db.run(status)
+    if not result:
+        return None
+    
+    # پیشرفت job های همین پروسه تازه‌تر از آخرین heartbeat است
+    progress = job_progress.get(job_id)
+    if progress and result['state'] == 'leased':
+        result.update(
+            stage=progress['stage'], bytes_done=progress['done'],
+            bytes_total=progress['total'], stage_started_at=progress['started_at'],
+            updated_at=time.time()
+        )
+    
+    # ETA از سرعت میانگین همین مرحله
+    eta = None
+    done, total = result['bytes_done'], result['bytes_total']
+    if result['state'] == 'leased' and done and total and result['stage_started_at']:
+        elapsed = result['updated_at'] - result['stage_started_at']
+        if elapsed > 0:
+            eta = round(max(total - done, 0) / (done / elapsed), 1)
+    
+    return {
+        'job_id': result['job_id'],
+        'state': 'cancelling' if result['cancel_requested'] and result['state'] == 'leased' else result['state'],
+        'stage': result['stage'],
+        'bytes_done': done,
+        'bytes_total': total,
+        'eta_seconds': eta,
+        'attempts': result['attempts'],
+        'error': result['error'],
+        'queue_position': result.get('queue_position'),
+        'created_at': result['created_at'],
+        'updated_at': result['updated_at']
+    }
+
+async def defer_job(job, worker_id, delay, priority=None, flight_key=None):
+    """
+    برگرداندن job به صف برای بعد (مثلا وقتی فضای دیسک کافی نیست)
+    - تعویق جزو تلاش‌های job حساب نمی‌شود
+    - مثل finish_job فقط با lease همین worker
+    - با flight_key، job منتظر دانلود همان لینک است و release_flight آن را بیدار می‌کند
+    """
+    now = time.time()
+    payload = {key: value for key, value in job.items() if key != 'attempts'}
+    cursor = await db.execute('''
+        UPDATE job_queue 
+        SET state = 'queued', payload = ?, worker_id = NULL, lease_expires_at = NULL,
+            attempts = attempts - 1, available_at = ?, updated_at = ?,
+            priority = COALESCE(?, priority), flight_key = ?, disk_reserved = 0
+        WHERE job_id = ? AND worker_id = ? AND state = 'leased'
+    ''', (json.dumps(payload), now + delay, now, priority, flight_key, job['job_id'], worker_id))
+    if not cursor.rowcount:
+        logger.warning(f"⚠️ Lease lost for {job['job_id']}, deferral discarded")
+    return cursor.rowcount > 0
+
+async def claim_flight(job_id, flight_key):
+    """
+    single-flight از طریق صف (بین همه پروسه‌های worker)
+    - این job دانلود لینک را بر عهده می‌گیرد مگر job lease شده دیگری همین کلید را داشته باشد
+    - بررسی و ثبت در یک UPDATE انجام می‌شود و دو job همزمان هر دو برنده نمی‌شوند
+    خروجی: True اگر این job باید دانلود کند
+    """
+    cursor = await db.execute('''
+        UPDATE job_queue SET flight_key = ?
+        WHERE job_id = ? AND state = 'leased' AND NOT EXISTS (
+            SELECT 1 FROM job_queue 
+            WHERE flight_key = ? AND state = 'leased' AND job_id != ?
+        )
+    ''', (flight_key, job_id, flight_key, job_id))
+    return cursor.rowcount > 0
+
+async def release_flight(job_id, flight_key):
+    """
+    پایان دانلود یک لینک (فایل در کش است یا دانلود شکست خورد)
+    - کلید از job اصلی برداشته می‌شود تا یکی از منتظرها بتواند claim کند
+    - منتظرها همین الان بیدار می‌شوند
+    """
+    def release(conn):
+        now = time.time()
         conn.execute('''
-            INSERT INTO user_history (user_id, url, filename, file_size)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, url, filename, file_size))
-        conn.commit()
+            UPDATE job_queue SET flight_key = NULL 
+            WHERE job_id = ? AND flight_key = ?
+        ''', (job_id, flight_key))
+        return conn.execute('''
+            UPDATE job_queue SET available_at = ?, updated_at = ?
+            WHERE flight_key = ? AND state = 'queued'
+        ''', (now, now, flight_key)).rowcount
+    
+    if await db.run(release):
+        job_available.set()
+
+async def requeue_leased_jobs(expired_only=True):
+    """برگرداندن job های lease شده به صف (بعد از crash یا انقضای lease)"""
+    now = time.time()
+    condition = "state = 'leased'"
+    params = [now]
+    if expired_only:
+        condition += " AND lease_expires_at < ?"
+        params.append(now)
+    
+    def requeue(conn):
+        # job هایی که لغو آن‌ها درخواست شده بود دوباره اجرا نمی‌شوند
+        conn.execute(f'''
+            UPDATE job_queue 
+            SET state = 'cancelled', error = 'cancelled by user', 
+                lease_expires_at = NULL, updated_at = ?
+            WHERE {condition} AND cancel_requested = 1
+        ''', params)
+        # job هایی که بارها worker را از کار انداخته‌اند دیگر تکرار نمی‌شوند
+        conn.execute(f'''
+            UPDATE job_queue 
+            SET state = 'failed', error = 'too many attempts', 
+                lease_expires_at = NULL, updated_at = ?
+            WHERE {condition} AND attempts >= ?
+        ''', params + [MAX_JOB_ATTEMPTS])
+        cursor = conn.execute(f'''
+            UPDATE job_queue 
+            SET state = 'queued', worker_id = NULL, 
+                lease_expires_at = NULL, updated_at = ?
+            WHERE {condition}
+        ''', params)
+        return cursor.rowcount
+    
+    requeued = await db.run(requeue)
+    
+    if requeued:
+        logger.warning(f"♻️ Requeued {requeued} leased jobs")
+        job_available.set()
+    return requeued
+
+async def purge_finished_jobs():
+    cutoff = time.time() - JOB_RETENTION_DAYS * 86400
+    await db.execute('''
+        DELETE FROM job_queue 
+        WHERE state IN ('done', 'failed', 'cancelled') AND updated_at < ?
+    ''', (cutoff,))
+
+async def get_queue_counts():
+    rows = await db.fetchall('''
+        SELECT state, COUNT(*) AS count FROM job_queue GROUP BY state
+    ''')
+    
+    counts = {'queued': 0, 'leased': 0, 'done': 0, 'failed': 0, 'cancelled': 0}
+    counts.update({row['state']: row['count'] for row in rows})
+    return counts
+
+def set_job_stage(stage):
+    """ثبت مرحله فعلی job در حال اجرا (heartbeat آن را در جدول ذخیره می‌کند)"""
+    job_id = current_job_id.get()
+    if job_id:
+        job_progress[job_id] = {'stage': stage, 'done': None, 'total': None, 'started_at': time.time()}
+
+def set_job_bytes(done, total):
+    progress = job_progress.get(current_job_id.get())
+    if progress:
+        progress['done'] = int(done)
+        progress['total'] = int(total) if total and total > 0 else None
 
 # ===========================
-# Telegram Client
+# Stage Limits
 # ===========================
-async def start_client():
-    global client
-    if client and client.is_connected():
-        return
+class StageLimiter:
+    """محدودیت همزمانی یک مرحله (دانلود، ffprobe، آپلود)"""
+    
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = max(1, limit)
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(self.limit)
+    
+    async def __aenter__(self):
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        self.active -= 1
+        self._semaphore.release()
     
-    client = TelegramClient('bot_session', API_ID, API_HASH)
+    def snapshot(self):
+        return {
+            'active': self.active,
+            'waiting': self.waiting,
+            'limit': self.limit
+        }
+
+stages = {
+    'download': StageLimiter('download', DOWNLOAD_SLOTS),
+    'probe': StageLimiter('probe', PROBE_SLOTS),
+    'upload': StageLimiter('upload', UPLOAD_SLOTS),
+}
+
+probe_service = ProbeService(stages['probe'])
+
+ytdlp_pool = YtdlpPool(
+    YTDLP_WORKERS, COOKIE_PATH, YTDLP_WORKER_MAX_JOBS, YTDLP_WORKER_MAX_RSS, YTDLP_EXTRACT_WORKERS
+) if YTDLP_WORKERS > 0 else None
+
+class JobDeferred(Exception):
+    """job فعلا قابل اجرا نیست و بعد از delay ثانیه دوباره از صف برداشته می‌شود"""
+    
+    def __init__(self, delay, priority=None, flight_key=None):
+        super().__init__(f"deferred for {delay}s")
+        self.delay = delay
+        self.priority = priority
+        self.flight_key = flight_key
+
+async def try_reserve_disk(job_id, size):
+    """
+    رزرو فضای پوشه دانلود برای job در حال اجرا
+    - رزرو در ستون disk_reserved ردیف lease شده است و بودجه بین همه پروسه‌های worker مشترک است
+    - بررسی و ثبت در یک UPDATE انجام می‌شود و دو job همزمان از بودجه رد نمی‌شوند
+    - اگر job تنها باشد همیشه پذیرفته می‌شود تا فایل بزرگتر از بودجه برای همیشه منتظر نماند
+    - با ثبت نتیجه یا تعویق job (finish_job / defer_job) آزاد می‌شود
+    """
+    cursor = await db.execute('''
+        UPDATE job_queue SET disk_reserved = ?
+        WHERE job_id = ? AND state = 'leased' AND (
+            NOT EXISTS (
+                SELECT 1 FROM job_queue 
+                WHERE state = 'leased' AND disk_reserved > 0 AND job_id != ?
+            )
+            OR (
+                SELECT SUM(disk_reserved) FROM job_queue 
+                WHERE state = 'leased' AND job_id != ?
+            ) + ? <= ?
+        )
+    ''', (size, job_id, job_id, job_id, size, DISK_BUDGET))
+    return cursor.rowcount > 0
+
+async def get_disk_usage():
+    """فضای رزرو شده همه job های در حال اجرا"""
+    row = await db.fetchone('''
+        SELECT COALESCE(SUM(disk_reserved), 0) AS reserved, 
+               COUNT(CASE WHEN disk_reserved > 0 THEN 1 END) AS jobs
+        FROM job_queue WHERE state = 'leased'
+    ''')
+    return {'reserved': row['reserved'], 'limit': DISK_BUDGET, 'jobs': row['jobs']}
+
+# ===========================
+# Telegram Client
+# ===========================
+async def new_client(session_name):
+    client = TelegramClient(session_name, API_ID, API_HASH)
     await client.start(bot_token=BOT_TOKEN)
-    logger.info("✅ Telegram client connected")
+    return client
+
+client_pool = ClientPool(new_client, session_names(TELEGRAM_SESSIONS, TELEGRAM_SESSION))
+
+async def start_client():
+    """client تلگرام درخواست فعلی (session ای که job به آن سپرده شده)"""
+    await client_pool.start()
+    return client_pool.client
 
 async def send_message(chat_id, text):
-    await start_client()
+    client = await start_client()
     return await client.send_message(chat_id, text)
 
 async def edit_message(chat_id, message_id, text):
-    await start_client()
+    client = await start_client()
     try:
         await client.edit_message(chat_id, message_id, text)
+    except FloodWaitError as e:
+        metrics.record_flood_wait('edit_message', e.seconds)
+        note_flood_wait(e.seconds)
     except Exception as e:
         logger.warning(f"Failed to edit message: {e}")
 
-# ===========================
-# URL Processing
-# ===========================
-def normalize_url(url):
-    if 'youtube.com/shorts/' in url:
-        video_id = url.split('/shorts/')[1].split('?')[0]
-        return f'https://www.youtube.com/watch?v={video_id}'
+def progress_reporter(chat_id, message_id, title, interval=4):
+    """callback پیشرفت که هر چند ثانیه پیام وضعیت را ویرایش می‌کند"""
+    last_update = 0
     
-    if 'youtu.be/' in url:
-        video_id = url.split('youtu.be/')[1].split('?')[0]
-        return f'https://www.youtube.com/watch?v={video_id}'
-    
-    if 'soundcloud.com' in url:
-        return url.split('?')[0]
-    
-    if 'pornhub.' in url or 'xvideos.' in url or 'xnxx.' in url:
-        return url
+    async def report(done, total):
+        nonlocal last_update
+        set_job_bytes(done, total)
+        if not message_id or total <= 0:
+            return
+        now = asyncio.get_event_loop().time()
+        if now - last_update > interval:
+            await edit_message(
+                chat_id, message_id,
+                f"{title}\n📊 {done / total * 100:.1f}%"
+            )
+            last_update = now
     
-    return url.split('?')[0]
+    return report
 
+# ===========================
+# URL Processing
+# ===========================
 def detect_url_type(url):
     if 'youtube.com' in url or 'youtu.be' in url:
         return 'youtube'
@@ -175,6 +971,9 @@ def detect_url_type(url):
         return 'pornhub'
     return 'direct'
 
+def detect_file_type(filename):
+    return 'video' if filename.endswith(('.mp4', '.mkv', '.avi', '.webm')) else 'document'
+
 def format_bytes(size):
     for unit in ['B', 'KB', 'MB', 'GB']:
         if size < 1024:
@@ -182,231 +981,705 @@ def format_bytes(size):
         size /= 1024
     return f"{size:.1f} TB"
 
-def get_video_info(filepath):
-    try:
-        import subprocess
-        import json
-        result = subprocess.run(
-            ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
-             '-show_entries', 'stream=width,height,duration',
-             '-of', 'json', filepath],
-            capture_output=True, text=True
-        )
-        data = json.loads(result.stdout)
-        stream = data.get('streams', [{}])[0]
-        return {
-            'width': stream.get('width', 1280),
-            'height': stream.get('height', 720),
-            'duration': int(float(stream.get('duration', 0)))
-        }
-    except:
-        return {'width': 1280, 'height': 720, 'duration': 0}
+async def probe_video(filepath, known=None):
+    """ابعاد و مدت ویدیو؛ از info خود yt-dlp یا ffprobe غیرهمزمان (با کش)"""
+    return await probe_service.probe(filepath, known)
 
 # ===========================
 # Download Functions
 # ===========================
-async def download_with_ytdlp(url, chat_id, message_id, custom_filename=None):
-    logger.info(f"📥 yt-dlp download: {url}")
-    os.makedirs(DOWNLOAD_PATH, exist_ok=True)
-    
-    url_type = detect_url_type(url)
-    emoji = '🎵' if url_type == 'soundcloud' else '🎬'
-    
-    cmd = [
-        'yt-dlp',
+def job_download_dir(job_id):
+    """پوشه اختصاصی هر job داخل DOWNLOAD_PATH"""
+    return os.path.join(DOWNLOAD_PATH, str(job_id))
+
+def cleanup_job_dir(download_dir):
+    """حذف کامل پوشه job (شامل فایل‌های .part و fragment ها)"""
+    if download_dir and os.path.isdir(download_dir):
+        shutil.rmtree(download_dir, ignore_errors=True)
+        logger.info(f"🗑️ Cleaned up: {download_dir}")
+
+def backoff_delay(attempt):
+    """تاخیر تلاش شماره attempt (از 1): نمایی با سقف و jitter"""
+    delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (attempt - 1))
+    return delay * random.uniform(0.5, 1)
+
+def is_transient_error(error):
+    """قطعی شبکه و خطاهای 5xx / 408 / 429 ارزش تلاش دوباره دارند، بقیه 4xx نه"""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status in (408, 429)
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+class RangeNotSupported(Exception):
+    """سرور با وجود Accept-Ranges درخواست Range را نادیده گرفت (HTTP 200 به جای 206)"""
+
+def parse_ytdlp_result(lines):
+    """خواندن خروجی JSON که yt-dlp بعد از دانلود چاپ می‌کند (آخرین خط JSON معتبر)"""
+    for line in reversed(lines):
+        try:
+            return json.loads(line)
+        except ValueError:
+            continue
+    return None
+
+def ytdlp_base_args(url_type):
+    """آرگومان‌های مشترک yt-dlp برای تخمین حجم و دانلود (باید یک فرمت را انتخاب کنند)"""
+    args = [
         '--no-warnings',
         '--no-playlist',
-        '-f', 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
+        '-f', YTDLP_FORMAT,
         '--merge-output-format', 'mp4',
-        '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+        '--user-agent', YTDLP_USER_AGENT
     ]
     
-    if custom_filename:
-        output_template = os.path.join(DOWNLOAD_PATH, custom_filename)
-        cmd.extend(['-o', output_template])
-    else:
-        cmd.extend(['-o', f'{DOWNLOAD_PATH}/%(title)s.%(ext)s'])
-    
     if url_type == 'pornhub':
-        cmd.extend(['--add-header', 'Referer:https://www.pornhub.com/'])
+        args.extend(['--add-header', 'Referer:https://www.pornhub.com/'])
     
-    cookie_path = '/app/cookies.txt'
-    if os.path.exists(cookie_path):
+    if os.path.exists(COOKIE_PATH):
         logger.info("🍪 Using cookies.txt")
-        cmd.extend(['--cookies', cookie_path])
+        args.extend(['--cookies', COOKIE_PATH])
     else:
         logger.warning("⚠️ cookies.txt not found - some sites may fail")
     
-    cmd.append(url)
+    return args
+
+def ytdlp_options(url_type):
+    """همان تنظیمات ytdlp_base_args برای worker های ytdlp_pool (cookies را خود worker دارد)"""
+    headers = {'User-Agent': YTDLP_USER_AGENT}
+    if url_type == 'pornhub':
+        headers['Referer'] = 'https://www.pornhub.com/'
+    
+    return {
+        'noplaylist': True,
+        'format': YTDLP_FORMAT,
+        'merge_output_format': 'mp4',
+        'http_headers': headers
+    }
+
+async def extract_ytdlp_info(url):
+    """
+    info کامل yt-dlp (عنوان، فرمت انتخاب شده، حجم، ابعاد و مدت) بدون دانلود
+    - از extract_cache اگر منقضی نشده باشد، وگرنه استخراج و ذخیره در کش
+    - None اگر استخراج ممکن نباشد (دانلود خودش دوباره تلاش می‌کند)
+    """
+    info = await get_extract_info(url)
+    if info:
+        return info
+    
+    url_type = detect_url_type(url)
+    try:
+        if ytdlp_pool:
+            info = await ytdlp_pool.run(
+                'extract', url, ytdlp_options(url_type), timeout=SIZE_ESTIMATE_TIMEOUT
+            )
+        else:
+            info = await asyncio.wait_for(run_ytdlp_extract(url, url_type), SIZE_ESTIMATE_TIMEOUT)
+    except (YtdlpError, OSError, ValueError, asyncio.TimeoutError) as e:
+        logger.warning(f"Extraction failed for {url}: {e}")
+        return None
     
+    await save_extract_info(url, info)
+    return info
+
+async def run_ytdlp_extract(url, url_type):
+    """استخراج info با CLI (-J)"""
     process = await asyncio.create_subprocess_exec(
-        *cmd,
+        'yt-dlp', *ytdlp_base_args(url_type), '--dump-single-json', url,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE
     )
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        raise
     
-    last_update = asyncio.get_event_loop().time()
+    if process.returncode != 0:
+        raise YtdlpError(stderr.decode('utf-8', errors='ignore').strip()[-500:], process.returncode)
+    return compact_info(json.loads(stdout))
+
+async def download_with_ytdlp(url, chat_id, message_id, custom_filename=None, download_dir=DOWNLOAD_PATH,
+                              info=None):
+    """
+    دانلود با yt-dlp (روی ytdlp_pool یا با اجرای CLI)
+    - با info استخراج شده (extract_cache) صفحه دوباره استخراج نمی‌شود
+    - اگر yt-dlp با خطای گذرا تمام شود با backoff دوباره اجرا می‌شود
+    - فایل‌های .part در پوشه job می‌مانند و اجرای بعدی (continue) از همان‌جا ادامه می‌دهد
+    """
+    logger.info(f"📥 yt-dlp download: {url}")
+    os.makedirs(download_dir, exist_ok=True)
+    
+    url_type = detect_url_type(url)
+    emoji = '🎵' if url_type == 'soundcloud' else '🎬'
+    
+    if custom_filename:
+        output_template = os.path.join(download_dir, custom_filename)
+    else:
+        output_template = f'{download_dir}/%(title)s.%(ext)s'
     
+    attempt = 0
     while True:
-        line = await process.stderr.readline()
-        if not line:
+        try:
+            if ytdlp_pool:
+                result = await ytdlp_pool.run(
+                    'download', url,
+                    {**ytdlp_options(url_type), 'outtmpl': output_template, 'continuedl': True},
+                    progress_reporter(chat_id, message_id, f"{emoji} در حال دانلود..."),
+                    info
+                )
+            else:
+                result = await run_ytdlp(url, url_type, output_template, chat_id, message_id, emoji, info)
+            metrics.YTDLP_EXITS.labels(url_type, '0').inc()
             break
+        except YtdlpError as e:
+            metrics.YTDLP_EXITS.labels(url_type, str(e.code)).inc()
+            error_msg = str(e)
+            attempt += 1
+            if info:
+                # info کش شده ممکن است علت خطا باشد؛ تلاش بعدی با استخراج تازه
+                await drop_extract_info(url)
+                info = None
+            if attempt > DOWNLOAD_RETRIES or any(marker in error_msg for marker in YTDLP_PERMANENT_ERRORS):
+                raise Exception(f"yt-dlp failed: {error_msg[:200]}")
         
-        line = line.decode('utf-8', errors='ignore')
-        
-        if '[download]' in line and '%' in line:
-            try:
-                percent = re.search(r'(\d+\.?\d*)%', line)
-                if percent:
-                    now = asyncio.get_event_loop().time()
-                    if now - last_update > 4:
-                        await edit_message(
-                            chat_id, message_id,
-                            f"{emoji} در حال دانلود...\n📊 {percent.group(1)}%"
-                        )
-                        last_update = now
-            except:
-                pass
+        delay = backoff_delay(attempt)
+        logger.warning(f"🔁 yt-dlp failed, retry {attempt} in {delay:.1f}s: {error_msg[-200:]}")
+        await edit_message(chat_id, message_id, f"🔁 خطای موقت، تلاش دوباره ({attempt}/{DOWNLOAD_RETRIES})...")
+        await asyncio.sleep(delay)
     
-    await process.wait()
+    # مسیر فایل از خروجی خود yt-dlp (بدون جستجو در پوشه)
+    if result and result.get('filepath') and os.path.exists(result['filepath']):
+        # ابعاد و مدتی که yt-dlp می‌داند (یا در info کش شده بود)، جای ffprobe را می‌گیرد
+        probe_service.remember(result['filepath'], result if result.get('duration') else info)
+        return result['filepath']
     
-    if process.returncode != 0:
-        stderr_output = await process.stderr.read()
-        error_msg = stderr_output.decode('utf-8', errors='ignore') if stderr_output else "Unknown error"
-        raise Exception(f"yt-dlp failed: {error_msg[:200]}")
+    raise Exception("No file downloaded - check if cookies.txt is needed")
+
+async def run_ytdlp(url, url_type, output_template, chat_id, message_id, emoji, info=None):
+    """یک اجرای CLI yt-dlp با گزارش پیشرفت؛ خروجی: info JSON که yt-dlp چاپ می‌کند"""
+    source = [url]
+    if info:
+        # --load-info-json اگر لینک فرمت‌ها منقضی شده باشد خودش از webpage_url استخراج می‌کند
+        info_path = os.path.join(os.path.dirname(output_template), '.info.json')
+        with open(info_path, 'w') as f:
+            json.dump(info, f)
+        source = ['--load-info-json', info_path]
     
-    # پیدا کردن فایل دانلود شده
-    extensions = ['*.mp4', '*.m4a', '*.mp3', '*.webm', '*.mkv']
-    files = []
-    for ext in extensions:
-        files.extend(list(Path(DOWNLOAD_PATH).glob(ext)))
+    cmd = [
+        'yt-dlp',
+        *ytdlp_base_args(url_type),
+        '--newline',
+        '--progress',
+        '--continue',
+        # مسیر دقیق فایل نهایی به صورت JSON در stdout
+        '--print', 'after_move:%(.{filepath,ext,title,width,height,duration})j',
+        '-o', output_template,
+        *source
+    ]
     
-    if files:
-        latest_file = max(files, key=os.path.getctime)
-        return str(latest_file)
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
     
-    raise Exception("No file downloaded - check if cookies.txt is needed")
-
-async def download_direct(url, filename, chat_id, message_id):
-    logger.info(f"📥 Direct download: {url}")
-    os.makedirs(DOWNLOAD_PATH, exist_ok=True)
-    filepath = os.path.join(DOWNLOAD_PATH, filename)
-    CHUNK_SIZE = 5 * 1024 * 1024
+    stderr_tail = deque(maxlen=5)
     
-    timeout = aiohttp.ClientTimeout(total=None, connect=60, sock_read=300)
+    async def read_stderr():
+        async for line in process.stderr:
+            line = line.decode('utf-8', errors='ignore').strip()
+            if line:
+                stderr_tail.append(line)
     
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, timeout=timeout) as response:
-            response.raise_for_status()
-            total_size = int(response.headers.get('content-length', 0))
-            downloaded = 0
-            last_update = 0
+    stderr_task = asyncio.create_task(read_stderr())
+    last_update = asyncio.get_event_loop().time()
+    results = []
+    
+    try:
+        # --print حالت quiet را روشن می‌کند؛ خط‌های progress (با --progress) و JSON نهایی هر دو در stdout هستند
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
             
-            with open(filepath, 'wb') as f:
-                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    
-                    if total_size > 0:
-                        progress = (downloaded / total_size) * 100
+            line = line.decode('utf-8', errors='ignore')
+            
+            if line.startswith('{'):
+                results.append(line.strip())
+            elif '[download]' in line and '%' in line:
+                try:
+                    percent = re.search(r'(\d+\.?\d*)%', line)
+                    if percent:
+                        total = re.search(r'of\s+~?\s*(\d+\.?\d*)([KMG]i?B)', line)
+                        if total:
+                            total_size = float(total.group(1)) * YTDLP_SIZE_UNITS[total.group(2)[0]]
+                            set_job_bytes(total_size * float(percent.group(1)) / 100, total_size)
                         now = asyncio.get_event_loop().time()
                         if now - last_update > 4:
                             await edit_message(
                                 chat_id, message_id,
-                                f"📥 در حال دانلود...\n📊 {progress:.1f}%"
+                                f"{emoji} در حال دانلود...\n📊 {percent.group(1)}%"
                             )
                             last_update = now
+                except asyncio.CancelledError:
+                    raise
+                except:
+                    pass
+        
+        await stderr_task
+        await process.wait()
+    finally:
+        # لغو job: yt-dlp همان لحظه kill می‌شود تا پهنای باند و دیسک آزاد شود
+        if process.returncode is None:
+            process.kill()
+            stderr_task.cancel()
+            logger.info(f"🛑 Killed yt-dlp for {url}")
+    
+    if process.returncode != 0:
+        raise YtdlpError('\n'.join(stderr_tail) or "Unknown error", process.returncode)
     
-    return filepath
+    return parse_ytdlp_result(results)
+
+async def download_direct(url, filename, chat_id, message_id, download_dir=DOWNLOAD_PATH, remote=None):
+    """
+    دانلود لینک مستقیم
+    خروجی: (مسیر فایل، hash محتوا) - hash همزمان با نوشتن حساب می‌شود
+    """
+    logger.info(f"📥 Direct download: {url}")
+    os.makedirs(download_dir, exist_ok=True)
+    filepath = os.path.join(download_dir, filename)
+    
+    if remote is None:
+        remote = await probe_direct_url(url)
+    
+    downloaded = 0
+    report = progress_reporter(chat_id, message_id, "📥 در حال دانلود...")
+    hasher = BlockHasher()
+    
+    async def on_progress(size, total_size):
+        nonlocal downloaded
+        downloaded += size
+        await report(downloaded, total_size)
+    
+    segments = min(DOWNLOAD_CONNECTIONS, remote['size'] // MIN_SEGMENT_SIZE)
+    if remote['accept_ranges'] and segments > 1:
+        try:
+            await download_ranged(url, filepath, remote['size'], segments, on_progress, hasher)
+        except RangeNotSupported as e:
+            # Accept-Ranges اشتباه اعلام شده؛ دانلود ساده با یک اتصال از اول
+            logger.warning(f"⚠️ {e} for {url}, downloading with one connection")
+            await on_progress(-downloaded, remote['size'])
+            hasher.reset()
+            await download_single(url, filepath, on_progress, hasher)
+    else:
+        await download_single(url, filepath, on_progress, hasher)
+    
+    return filepath, hasher.hexdigest()
+
+async def download_single(url, filepath, on_progress, hasher=None):
+    """
+    دانلود با یک اتصال (وقتی سرور Range را پشتیبانی نمی‌کند یا فایل کوچک است)
+    - بعد از قطعی با backoff دوباره تلاش می‌کند و با Range از آخرین بایت نوشته شده ادامه می‌دهد
+    - If-Range تضمین می‌کند اگر فایل روی سرور عوض شده باشد از اول دانلود شود
+    """
+    CHUNK_SIZE = 5 * 1024 * 1024
+    timeout = aiohttp.ClientTimeout(total=None, connect=60, sock_read=300)
+    offset = 0
+    total_size = 0
+    validator = None
+    attempts = 0
+    
+    with open(filepath, 'wb') as f:
+        async with aiohttp.ClientSession() as session:
+            while True:
+                headers = {'Accept-Encoding': 'identity'}
+                if offset:
+                    headers['Range'] = f'bytes={offset}-'
+                    if validator:
+                        headers['If-Range'] = validator
+                
+                try:
+                    async with session.get(url, timeout=timeout, headers=headers) as response:
+                        response.raise_for_status()
+                        if offset and response.status != 206:
+                            # Range پذیرفته نشد یا فایل عوض شده؛ دانلود از بایت صفر
+                            logger.warning(f"⚠️ Resume not possible for {url}, restarting")
+                            await on_progress(-offset, total_size)
+                            offset = 0
+                            f.seek(0)
+                            f.truncate()
+                            if hasher:
+                                hasher.reset()
+                        if not offset:
+                            total_size = int(response.headers.get('content-length', 0))
+                            validator = response.headers.get('etag') or response.headers.get('last-modified')
+                        
+                        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                            if hasher:
+                                hasher.update(offset, chunk)
+                            f.write(chunk)
+                            offset += len(chunk)
+                            await on_progress(len(chunk), total_size)
+                    
+                    if total_size and offset < total_size:
+                        raise aiohttp.ClientPayloadError(f"Download ended early at {offset}/{total_size}")
+                    return
+                
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    attempts += 1
+                    if attempts > DOWNLOAD_RETRIES or not is_transient_error(e):
+                        raise
+                    delay = backoff_delay(attempts)
+                    logger.warning(f"🔁 Download retry {attempts} from {offset} in {delay:.1f}s: {e}")
+                    await asyncio.sleep(delay)
+
+async def download_ranged(url, filepath, total_size, segments, on_progress, hasher=None):
+    """
+    دانلود همزمان چند بازه (Range) در یک فایل از پیش رزرو شده
+    هر بازه در صورت قطعی از آخرین بایت دریافت شده ادامه پیدا می‌کند
+    """
+    CHUNK_SIZE = 1024 * 1024
+    timeout = aiohttp.ClientTimeout(total=None, connect=60, sock_read=300)
+    # مرز بازه‌ها روی مرز بلوک‌های hash تا هر بلوک فقط توسط یک بازه و به ترتیب نوشته شود
+    segment_size = align_to_blocks(-(-total_size // segments))
+    
+    # رزرو کامل فایل تا هر بازه در جای خودش نوشته شود
+    with open(filepath, 'wb') as f:
+        f.truncate(total_size)
+    
+    fd = os.open(filepath, os.O_WRONLY)
+    
+    async def fetch_segment(session, start, end):
+        offset = start
+        attempts = 0
+        
+        while offset <= end:
+            try:
+                async with session.get(
+                    url, timeout=timeout,
+                    headers={'Range': f'bytes={offset}-{end}', 'Accept-Encoding': 'identity'}
+                ) as response:
+                    response.raise_for_status()
+                    if response.status != 206:
+                        raise RangeNotSupported(f"Range not honoured (HTTP {response.status})")
+                    
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        chunk = chunk[:end - offset + 1]
+                        os.pwrite(fd, chunk, offset)
+                        if hasher:
+                            hasher.update(offset, chunk)
+                        offset += len(chunk)
+                        await on_progress(len(chunk), total_size)
+                        if offset > end:
+                            break
+                
+                if offset <= end:
+                    raise aiohttp.ClientPayloadError(f"Segment {start}-{end} ended early")
+            
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                attempts += 1
+                if attempts > SEGMENT_RETRIES or not is_transient_error(e):
+                    raise
+                delay = backoff_delay(attempts)
+                logger.warning(f"🔁 Segment {start}-{end} retry {attempts} from {offset} in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+    
+    try:
+        async with aiohttp.ClientSession() as session:
+            tasks = [
+                asyncio.create_task(
+                    fetch_segment(session, start, min(start + segment_size, total_size) - 1)
+                )
+                for start in range(0, total_size, segment_size)
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # با شکست یک بازه بقیه هم متوقف می‌شوند
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+    finally:
+        os.close(fd)
+
+async def probe_direct_url(url):
+    """حجم فایل و پشتیبانی از Range با یک درخواست HEAD"""
+    timeout = aiohttp.ClientTimeout(total=30)
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.head(
+                url, timeout=timeout, allow_redirects=True,
+                headers={'Accept-Encoding': 'identity'}
+            ) as response:
+                response.raise_for_status()
+                return {
+                    'size': int(response.headers.get('content-length', 0)),
+                    'accept_ranges': response.headers.get('accept-ranges', '').lower() == 'bytes'
+                }
+    except Exception as e:
+        logger.warning(f"HEAD failed for {url}: {e}")
+    
+    return {'size': 0, 'accept_ranges': False}
+
+async def stream_chunks(session, url, file_size, chunk_size, start=0, end=None):
+    """
+    bytes بازه [start, end) لینک مستقیم به ترتیب، با ادامه از آخرین بایت بعد از قطعی (Range + If-Range)
+    - مصرف‌کننده (upload_ranges) قطعی را نمی‌بیند و از part بعدی ادامه می‌دهد
+    - اگر سرور Range را نپذیرد یا فایل عوض شده باشد RangeNotSupported می‌دهد
+    """
+    timeout = aiohttp.ClientTimeout(total=None, connect=60, sock_read=300)
+    end = file_size if end is None else end
+    offset = start
+    validator = None
+    attempts = 0
+    
+    while offset < end:
+        headers = {'Accept-Encoding': 'identity'}
+        ranged = offset > 0 or end < file_size
+        if ranged:
+            headers['Range'] = f'bytes={offset}-{end - 1}'
+            if validator:
+                headers['If-Range'] = validator
+        
+        try:
+            async with session.get(url, timeout=timeout, headers=headers) as response:
+                response.raise_for_status()
+                if ranged and response.status != 206:
+                    raise RangeNotSupported(f"Cannot stream from {offset} (HTTP {response.status})")
+                if not ranged and int(response.headers.get('content-length', 0)) != file_size:
+                    raise Exception("Content-Length changed between HEAD and GET")
+                if not validator:
+                    validator = response.headers.get('etag') or response.headers.get('last-modified')
+                
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    chunk = chunk[:end - offset]
+                    offset += len(chunk)
+                    yield chunk
+                    if offset >= end:
+                        break
+            
+            if offset < end:
+                raise aiohttp.ClientPayloadError(f"Stream ended early at {offset}/{end}")
+        
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            attempts += 1
+            if attempts > DOWNLOAD_RETRIES or not is_transient_error(e):
+                raise
+            delay = backoff_delay(attempts)
+            logger.warning(f"🔁 Stream retry {attempts} from {offset} in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+
+async def stream_direct_upload(url, filename, file_size, file_type, chat_id, message_id,
+                               accept_ranges=False):
+    """
+    دانلود لینک مستقیم و آپلود همزمان part ها به تلگرام
+    - با پشتیبانی سرور از Range، مثل download_ranged با چند اتصال (هر بازه part های خودش را می‌دهد)
+    - قطعی دانلود از همان بایت ادامه پیدا می‌کند (stream_chunks)؛ part های آپلود شده تکرار نمی‌شوند
+    خروجی: (InputFile, video_info, hash محتوا) برای send_uploaded
+    """
+    logger.info(f"📡 Streaming to backup: {url}")
+    client = await start_client()
+    
+    CHUNK_SIZE = 256 * 1024
+    
+    # ffprobe مستقیم روی URL، همزمان با آپلود
+    probe_task = asyncio.create_task(probe_video(url)) if file_type == 'video' else None
+    hasher = BlockHasher()
+    
+    # مرز بازه‌ها روی مرز بلوک‌های hash (و در نتیجه part ها) مثل download_ranged
+    segments = min(DOWNLOAD_CONNECTIONS, file_size // MIN_SEGMENT_SIZE) if accept_ranges else 1
+    segment_size = align_to_blocks(-(-file_size // max(1, segments)))
+    
+    async def fetch_range(session, start, end):
+        offset = start
+        async for chunk in stream_chunks(session, url, file_size, CHUNK_SIZE, start, end):
+            hasher.update(offset, chunk)
+            offset += len(chunk)
+            yield chunk
+    
+    async def upload(ranges):
+        async with aiohttp.ClientSession() as session:
+            return await upload_ranges(
+                client,
+                lambda start, end: fetch_range(session, start, end),
+                file_size,
+                filename,
+                ranges,
+                part_size=UPLOAD_PART_SIZE,
+                buffer_parts=STREAM_BUFFER_PARTS,
+                connections=UPLOAD_CONNECTIONS,
+                parallel=UPLOAD_PARALLEL,
+                progress_callback=progress_reporter(
+                    chat_id, message_id, "📡 در حال دانلود و آپلود..."
+                )
+            )
+    
+    try:
+        async with stages['upload']:
+            ranges = [
+                (start, min(start + segment_size, file_size))
+                for start in range(0, file_size, segment_size)
+            ]
+            try:
+                input_file = await upload(ranges)
+            except RangeNotSupported as e:
+                if len(ranges) == 1:
+                    raise
+                # Accept-Ranges اشتباه اعلام شده؛ stream ساده با یک اتصال از اول
+                logger.warning(f"⚠️ {e} for {url}, streaming with one connection")
+                hasher.reset()
+                input_file = await upload([(0, file_size)])
+        
+        video_info = await probe_task if probe_task else None
+    finally:
+        if probe_task and not probe_task.done():
+            probe_task.cancel()
+    
+    return input_file, video_info, hasher.hexdigest()
 
 # ===========================
 # Upload Functions
 # ===========================
-async def upload_to_backup_channel(filepath, file_type='video'):
-    if not BACKUP_CHANNEL_ID:
-        return None
+def build_attributes(filename, video_info=None):
+    attributes = [DocumentAttributeFilename(filename)]
     
-    try:
-        await start_client()
-        filename = os.path.basename(filepath)
-        file_size = os.path.getsize(filepath)
-        
-        attributes = [DocumentAttributeFilename(filename)]
-        
-        if file_type == 'video':
-            video_info = get_video_info(filepath)
-            if video_info['duration'] > 0:
-                attributes.append(DocumentAttributeVideo(
-                    duration=video_info['duration'],
-                    w=video_info['width'] or 1280,
-                    h=video_info['height'] or 720,
-                    supports_streaming=True
-                ))
-        
-        message = await client.send_file(
-            BACKUP_CHANNEL_ID,
-            filepath,
-            caption=f"📦 {filename}\n💾 {format_bytes(file_size)}",
-            attributes=attributes,
-            force_document=(file_type != 'video')
-        )
-        
-        if message:
-            return str(message.id)
+    if video_info and video_info['duration'] > 0:
+        attributes.append(DocumentAttributeVideo(
+            duration=video_info['duration'],
+            w=video_info['width'] or 1280,
+            h=video_info['height'] or 720,
+            supports_streaming=True
+        ))
+    
+    return attributes
+
+async def upload_parts(filepath, progress_callback=None):
+    """آپلود موازی part های فایل؛ خروجی برای send_file قابل استفاده است"""
+    client = await start_client()
+    return await upload_file(
+        client,
+        filepath,
+        part_size=UPLOAD_PART_SIZE,
+        connections=UPLOAD_CONNECTIONS,
+        parallel=UPLOAD_PARALLEL,
+        progress_callback=progress_callback
+    )
+
+async def upload_once(filepath, progress_callback=None):
+    """
+    آپلود bytes فایل فقط یک بار
+    - InputFile خروجی برای کانال پشتیبان یا کاربر استفاده می‌شود، نه دوباره آپلود
+    """
+    await start_client()
+    async with stages['upload']:
+        return await upload_parts(filepath, progress_callback)
+
+async def send_uploaded(chat_id, input_file, filename, file_size, file_type='video', video_info=None,
+                        caption_icon='📁', reply_to=None):
+    """ارسال یک InputFile آپلود شده به یک چت"""
+    client = await start_client()
+    attributes = build_attributes(filename, video_info if file_type == 'video' else None)
+    return await client.send_file(
+        chat_id,
+        input_file,
+        caption=f"{caption_icon} {filename}\n💾 {format_bytes(file_size)}",
+        attributes=attributes,
+        force_document=(file_type != 'video'),
+        reply_to=reply_to
+    )
+
+async def refresh_media_handle(file_id):
+    """گرفتن دوباره پیام پشتیبان و به‌روزرسانی handle در همه ردیف‌های کش"""
+    client = await start_client()
+    message = await client.get_messages(BACKUP_CHANNEL_ID, ids=int(file_id))
+    handle = media_handle(message)
+    if not handle:
+        raise Exception(f"Backup message {file_id} has no document")
+    
+    await db.execute('''
+        UPDATE file_cache SET doc_id = ?, access_hash = ?, file_reference = ?
+        WHERE file_id = ?
+    ''', (handle['doc_id'], handle['access_hash'], handle['file_reference'], str(file_id)))
     
+    return handle
+
+async def find_backup_duplicate(content_hash, file_size):
+    """
+    پیام پشتیبانی که همین محتوا را دارد (از لینک دیگری)؛ خروجی: (file_id, handle) یا (None, None)
+    - برای فایل روی دیسک جای آپلود را می‌گیرد؛ فایل استریم شده قبل از این بررسی آپلود شده
+      و فقط پیام تکراری در کانال پشتیبان ساخته نمی‌شود (پهنای باند آپلود صرفه‌جویی نمی‌شود)
+    """
+    if not content_hash or not BACKUP_CHANNEL_ID:
+        return None, None
+    
+    duplicate = await get_cached_by_content(content_hash, file_size)
+    if not duplicate:
+        return None, None
+    
+    # پیام پشتیبان ممکن است پاک شده باشد؛ یک get_messages به جای آپلود کامل
+    try:
+        handle = await refresh_media_handle(duplicate['file_id'])
     except Exception as e:
-        logger.error(f"⚠️ Backup upload failed: {e}")
+        logger.warning(f"⚠️ Backup message {duplicate['file_id']} unusable: {e}")
+        await db.execute(
+            'UPDATE file_cache SET content_hash = NULL WHERE file_id = ?',
+            (duplicate['file_id'],)
+        )
+        return None, None
     
-    return None
+    logger.info(f"♻️ Same content already in backup: {duplicate['file_id']}")
+    return duplicate['file_id'], handle
 
-async def forward_from_backup(chat_id, file_id, reply_to_message_id=None):
+async def forward_from_backup(chat_id, file_id, reply_to_message_id=None, handle=None):
     if not BACKUP_CHANNEL_ID:
         return False
     
     try:
-        await start_client()
+        client = await start_client()
         
-        await client.send_file(
-            chat_id,
-            file=int(file_id),
-            reply_to=reply_to_message_id
-        )
+        # با handle ذخیره شده فقط یک send_file لازم است
+        if not handle:
+            handle = await refresh_media_handle(file_id)
+        
+        try:
+            await client.send_file(
+                chat_id,
+                file=input_media(handle),
+                reply_to=reply_to_message_id
+            )
+        except (FileReferenceExpiredError, FileReferenceInvalidError):
+            logger.info(f"🔄 File reference expired for {file_id}, refreshing")
+            handle = await refresh_media_handle(file_id)
+            await client.send_file(
+                chat_id,
+                file=input_media(handle),
+                reply_to=reply_to_message_id
+            )
         
         return True
     except Exception as e:
         logger.error(f"⚠️ Forward failed: {e}")
         return False
 
-async def upload_to_telegram(chat_id, filepath, message_id=None, as_video=False):
-    await start_client()
-    filename = os.path.basename(filepath)
-    file_size = os.path.getsize(filepath)
-    
-    attributes = [DocumentAttributeFilename(filename)]
-    
-    if as_video:
-        video_info = get_video_info(filepath)
-        if video_info['duration'] > 0:
-            attributes.append(DocumentAttributeVideo(
-                duration=video_info['duration'],
-                w=video_info['width'] or 1280,
-                h=video_info['height'] or 720,
-                supports_streaming=True
-            ))
-    
-    await client.send_file(
-        chat_id,
-        filepath,
-        caption=f"📁 {filename}\n💾 {format_bytes(file_size)}",
-        attributes=attributes,
-        force_document=(not as_video),
-        reply_to=message_id
-    )
-
 # ===========================
 # 🔥 JOB PROCESSOR
 # ===========================
+async def reserve_disk(job, size, status_msg_id):
+    """رزرو فضای پوشه دانلود برای job؛ اگر جا نیست job به صف برمی‌گردد (JobDeferred)"""
+    if not await try_reserve_disk(job['job_id'], size):
+        logger.info(f"💽 Not enough disk budget for {job['job_id']}, deferring")
+        await edit_message(job['chat_id'], status_msg_id, "⏳ در صف (منتظر فضای خالی)...")
+        raise JobDeferred(ADMISSION_RETRY_DELAY)
+
 async def process_job(job):
+    """
+    پردازش یک job روی session تلگرام با کمترین بار
+    - InputFile آپلود شده فقط در همان session معتبر است، پس کل job روی یک session می‌ماند
+    """
+    async with client_pool.assign():
+        await handle_job(job)
+
+async def handle_job(job):
     """پردازش یک job"""
     url = job['url']
     chat_id = job['chat_id']
@@ -414,109 +1687,412 @@ async def process_job(job):
     message_id = job['message_id']
     custom_filename = job.get('custom_filename')
     
-    status_msg = None
+    status_msg_id = job.get('status_message_id')
     filepath = None
+    download_dir = job_download_dir(job['job_id'])
+    leading = False
+    # job های با نام دلخواه خروجی متفاوتی دارند و بدون کانال پشتیبان هم
+    # پیامی برای اشتراک وجود ندارد؛ این دو حالت ادغام نمی‌شوند
+    flight_key = None if custom_filename or not BACKUP_CHANNEL_ID else canonical_key(url)
+    url_type = detect_url_type(url)
+    current_job_id.set(job['job_id'])
     
     try:
         logger.info(f"🔄 Processing job: {job['job_id']}")
         
-        # ارسال پیام شروع
-        status_msg = await send_message(chat_id, "⏳ در حال پردازش...")
-        status_msg_id = status_msg.id
+        # ارسال پیام شروع (job تعویق خورده پیام قبلی خودش را دارد)
+        if not status_msg_id:
+            status_msg = await send_message(chat_id, "⏳ در حال پردازش...")
+            status_msg_id = job['status_message_id'] = status_msg.id
         
         # چک کردن کش
-        cached = await get_cached_file(url)
+        set_job_stage('cache_lookup')
+        with metrics.stage_timer('cache_lookup', url_type):
+            cached = await get_cached_file(url)
         if cached:
             logger.info(f"💾 Using cached file for {url}")
             await edit_message(chat_id, status_msg_id, "📦 فایل از کش...")
+            set_job_stage('forward')
             
-            forwarded = await forward_from_backup(
-                chat_id, 
-                cached['file_id'], 
-                message_id
-            )
+            with metrics.stage_timer('forward', url_type):
+                forwarded = await forward_from_backup(
+                    chat_id, 
+                    cached['file_id'], 
+                    message_id,
+                    cached['handle']
+                )
             
             if forwarded:
                 await edit_message(chat_id, status_msg_id, "✅ ارسال شد (از کش)")
                 await add_to_user_history(user_id, url, cached['filename'], cached['file_size'])
                 return
         
-        # دانلود فایل
-        url_type = detect_url_type(url)
-        
-        await edit_message(chat_id, status_msg_id, "📥 در حال دانلود...")
+        # اگر همین لینک الان برای کاربر دیگری در حال دانلود است (در هر پروسه worker)،
+        # job بدون اشغال worker به صف برمی‌گردد و بعد از آماده شدن فایل به عنوان hit کش
+        # برداشته می‌شود؛ اگر دانلود شکست بخورد یا job تعویق بخورد، finally منتظرها را
+        # بیدار می‌کند و یکی از آن‌ها خودش دانلود می‌کند
+        if flight_key:
+            leading = await claim_flight(job['job_id'], flight_key)
+            if not leading:
+                logger.info(f"🔗 {flight_key} is already downloading, waiting in queue")
+                if not job.get('flight_waiting'):
+                    job['flight_waiting'] = True
+                    await edit_message(chat_id, status_msg_id, "⏳ این لینک در حال دانلود است، منتظر بمانید...")
+                raise JobDeferred(FLIGHT_WAIT_DELAY, priority=1, flight_key=flight_key)
         
+        # تخمین حجم قبل از دانلود: رد فایل‌های بزرگتر از حد تلگرام و رزرو فضای دیسک
+        set_job_stage('admission')
+        remote = None
+        ytdlp_info = None
         if url_type in ['youtube', 'soundcloud', 'pornhub']:
-            filepath = await download_with_ytdlp(url, chat_id, status_msg_id, custom_filename)
+            ytdlp_info = await extract_ytdlp_info(url)
+            expected_size = info_size(ytdlp_info)
+            disk_needed = (expected_size or UNKNOWN_JOB_SIZE) * YTDLP_DISK_FACTOR
         else:
-            filename = custom_filename or url.split('/')[-1]
-            filepath = await download_direct(url, filename, chat_id, status_msg_id)
+            remote = await probe_direct_url(url)
+            expected_size = remote['size'] or None
+            disk_needed = expected_size or UNKNOWN_JOB_SIZE
         
-        if not filepath or not os.path.exists(filepath):
-            raise Exception("فایل دانلود نشد")
+        if expected_size and expected_size > MAX_FILE_SIZE:
+            raise Exception(
+                f"حجم فایل ({format_bytes(expected_size)}) بیشتر از حد مجاز "
+                f"{format_bytes(MAX_FILE_SIZE)} است"
+            )
         
-        file_size = os.path.getsize(filepath)
-        filename = os.path.basename(filepath)
+        # فایل‌های بزرگ با حجم معلوم مستقیم به تلگرام استریم می‌شوند و دیسک لازم ندارند
+        streaming = bool(
+            remote and DIRECT_STREAMING and BACKUP_CHANNEL_ID and remote['size'] >= STREAM_MIN_SIZE
+        )
+        if not streaming:
+            await reserve_disk(job, disk_needed, status_msg_id)
         
-        logger.info(f"✅ Downloaded: {filename} ({format_bytes(file_size)})")
+        # دانلود فایل
+        set_job_stage('download')
+        await edit_message(chat_id, status_msg_id, "📥 در حال دانلود...")
         
-        # آپلود به کانال پشتیبان
-        await edit_message(chat_id, status_msg_id, "📤 در حال آپلود...")
+        backup_message = None
+        backup_file_id = None
+        handle = None
+        input_file = None
+        video_info = None
+        content_hash = None
         
-        file_type = 'video' if filepath.endswith(('.mp4', '.mkv', '.avi', '.webm')) else 'document'
-        backup_file_id = await upload_to_backup_channel(filepath, file_type)
+        async with stages['download']:
+            if url_type in ['youtube', 'soundcloud', 'pornhub']:
+                with metrics.stage_timer('download', url_type):
+                    filepath = await download_with_ytdlp(
+                        url, chat_id, status_msg_id, custom_filename, download_dir, ytdlp_info
+                    )
+            else:
+                filename = custom_filename or url.split('/')[-1]
+                file_type = detect_file_type(filename)
+                
+                if streaming:
+                    file_size = remote['size']
+                    try:
+                        set_job_stage('stream')
+                        # دانلود و آپلود همزمان؛ مدت آن جدا از download / backup_upload ثبت می‌شود
+                        with metrics.stage_timer('stream', url_type):
+                            input_file, video_info, content_hash = await stream_direct_upload(
+                                url, filename, file_size, file_type, chat_id, status_msg_id,
+                                remote['accept_ranges']
+                            )
+                        metrics.DOWNLOADED_BYTES.labels(url_type).inc(file_size)
+                        metrics.UPLOADED_BYTES.labels(url_type).inc(file_size)
+                    except Exception as e:
+                        # قطعی‌های گذرا داخل stream_chunks ادامه داده شده‌اند؛ اینجا یعنی ادامه ممکن نبود
+                        logger.warning(f"⚠️ Streaming failed, staging on disk: {e}")
+                        await reserve_disk(job, disk_needed, status_msg_id)
+                
+                if not input_file:
+                    set_job_stage('download')
+                    with metrics.stage_timer('download', url_type):
+                        filepath, content_hash = await download_direct(
+                            url, filename, chat_id, status_msg_id, download_dir, remote
+                        )
+        
+        if not input_file:
+            if not filepath or not os.path.exists(filepath):
+                raise Exception("فایل دانلود نشد")
+            
+            file_size = os.path.getsize(filepath)
+            filename = os.path.basename(filepath)
+            file_type = detect_file_type(filepath)
+            
+            if file_size > MAX_FILE_SIZE:
+                raise Exception(
+                    f"حجم فایل ({format_bytes(file_size)}) بیشتر از حد مجاز "
+                    f"{format_bytes(MAX_FILE_SIZE)} است"
+                )
+            
+            logger.info(f"✅ Downloaded: {filename} ({format_bytes(file_size)})")
+            metrics.DOWNLOADED_BYTES.labels(url_type).inc(file_size)
+            
+            # همین محتوا قبلا از لینک دیگری در کانال پشتیبان آپلود شده؟
+            backup_file_id, handle = await find_backup_duplicate(content_hash, file_size)
+            
+            if not backup_file_id:
+                # آپلود فایل (فقط یک بار)
+                await edit_message(chat_id, status_msg_id, "📤 در حال آپلود...")
+                
+                if file_type == 'video':
+                    set_job_stage('probe')
+                    with metrics.stage_timer('probe', url_type):
+                        video_info = await probe_video(filepath)
+                set_job_stage('upload')
+                upload_progress = progress_reporter(chat_id, status_msg_id, "📤 در حال آپلود...")
+                with metrics.stage_timer('backup_upload', url_type):
+                    input_file = await upload_once(filepath, upload_progress)
+                metrics.UPLOADED_BYTES.labels(url_type).inc(file_size)
+        
+        else:
+            # استریم شده: bytes آپلود شده‌اند ولی پیام پشتیبان تکراری ساخته نمی‌شود
+            backup_file_id, handle = await find_backup_duplicate(content_hash, file_size)
+        
+        # bytes فقط یک بار آپلود شده‌اند؛ همان InputFile یا media پیام پشتیبان استفاده می‌شود
+        if input_file and BACKUP_CHANNEL_ID and not backup_file_id:
+            try:
+                backup_message = await send_uploaded(
+                    BACKUP_CHANNEL_ID, input_file, filename, file_size,
+                    file_type, video_info, caption_icon='📦'
+                )
+            except Exception as e:
+                logger.error(f"⚠️ Backup upload failed: {e}")
+        
+        if backup_message:
+            backup_file_id = str(backup_message.id)
+            handle = media_handle(backup_message)
+        elif input_file and not backup_file_id:
+            # بدون کانال پشتیبان، همان فایل آپلود شده مستقیم برای کاربر فرستاده می‌شود
+            await send_uploaded(
+                chat_id, input_file, filename, file_size,
+                file_type, video_info, reply_to=message_id
+            )
         
         # فوروارد به کاربر
+        set_job_stage('forward')
         if backup_file_id:
-            await forward_from_backup(chat_id, backup_file_id, message_id)
-            await save_to_cache(url, backup_file_id, file_type, filename, file_size)
-        else:
-            # اگر کانال پشتیبان نداریم، مستقیم آپلود کن
-            as_video = file_type == 'video'
-            await upload_to_telegram(chat_id, filepath, message_id, as_video)
+            await save_to_cache(
+                url, backup_file_id, file_type, filename, file_size, handle, content_hash
+            )
+            if leading:
+                await release_flight(job['job_id'], flight_key)
+                leading = False
+            with metrics.stage_timer('forward', url_type):
+                forwarded = await forward_from_backup(chat_id, backup_file_id, message_id, handle)
+            if not forwarded:
+                # InputFile آپلود شده هنوز معتبر است؛ مستقیم برای کاربر فرستاده می‌شود
+                logger.warning(f"⚠️ Forward failed, sending {filename} directly")
+                if not input_file:
+                    # محتوای تکراری بود و آپلود نشده بود؛ فایل هنوز در پوشه job است
+                    if file_type == 'video' and not video_info:
+                        video_info = await probe_video(filepath)
+                    set_job_stage('upload')
+                    input_file = await upload_once(filepath)
+                    metrics.UPLOADED_BYTES.labels(url_type).inc(file_size)
+                await send_uploaded(
+                    chat_id, input_file, filename, file_size,
+                    file_type, video_info, reply_to=message_id
+                )
         
         await edit_message(chat_id, status_msg_id, "✅ ارسال شد!")
         await add_to_user_history(user_id, url, filename, file_size)
         
         logger.info(f"✅ Job completed: {filename}")
         
+    except JobDeferred:
+        raise
+    
     except Exception as e:
         logger.error(f"❌ Job failed: {e}")
+        if isinstance(e, FloodWaitError):
+            metrics.record_flood_wait('job', e.seconds)
+            note_flood_wait(e.seconds)
         error_msg = f"❌ خطا: {str(e)[:200]}"
-        if status_msg:
-            await edit_message(chat_id, status_msg.id, error_msg)
+        if status_msg_id:
+            await edit_message(chat_id, status_msg_id, error_msg)
         else:
             await send_message(chat_id, error_msg)
+        raise
     
     finally:
-        # پاک کردن فایل موقت
-        if filepath and os.path.exists(filepath):
+        job_progress.pop(job['job_id'], None)
+        
+        # بیدار کردن منتظرهای همین لینک (اگر فایلی در کش نبود یکی از آن‌ها دانلود می‌کند)
+        if leading:
             try:
-                os.remove(filepath)
-                logger.info(f"🗑️ Cleaned up: {filepath}")
+                await release_flight(job['job_id'], flight_key)
             except Exception as e:
-                logger.warning(f"Failed to clean up file: {e}")
+                logger.warning(f"Failed to wake waiters of {flight_key}: {e}")
+        
+        # پاک کردن پوشه موقت job
+        cleanup_job_dir(download_dir)
+
+async def lease_heartbeat(job_id, worker_id, job_task):
+    """
+    تمدید lease و ذخیره پیشرفت تا زمانی که job در حال پردازش است
+    - اگر از پروسه دیگری (API) درخواست لغو ثبت شده باشد job متوقف می‌شود
+    - اگر lease از دست رفته باشد (منقضی و دوباره واگذار شده) هم job متوقف می‌شود
+    """
+    while True:
+        await asyncio.sleep(min(JOB_STATUS_INTERVAL, LEASE_TIMEOUT / 3))
+        try:
+            cancel_requested = await renew_lease(job_id, worker_id, job_progress.get(job_id))
+            if cancel_requested is None:
+                # lease منقضی شده و job شاید دست worker دیگری است؛ ادامه دادن یعنی دو اجرا
+                logger.warning(f"⚠️ Lease lost for {job_id}, stopping job")
+                lost_leases.add(job_id)
+                job_task.cancel()
+                return
+            if cancel_requested:
+                logger.info(f"🛑 Cancel requested for {job_id}")
+                cancelled_jobs.add(job_id)
+                job_task.cancel()
+                return
+        except Exception as e:
+            logger.warning(f"Failed to renew lease for {job_id}: {e}")
 
-async def worker_loop():
+async def worker_loop(worker_id=0):
     """حلقه اصلی worker"""
-    logger.info("🚀 Worker loop started")
+    logger.info(f"🚀 Worker loop {worker_id} started")
+    lease_owner = f"{WORKER_NAME}/{worker_id}"
     
     while True:
         try:
             # گرفتن job از صف
-            job = await job_queue.get()
-            logger.info(f"📋 Got job from queue: {job['job_id']}")
+            job = await lease_job(lease_owner)
+            if not job:
+                job_available.clear()
+                try:
+                    await asyncio.wait_for(job_available.wait(), QUEUE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
             
-            # پردازش job
-            await process_job(job)
+            logger.info(f"📋 Worker {worker_id} leased job: {job['job_id']}")
             
-            # علامت‌گذاری job به عنوان انجام شده
-            job_queue.task_done()
+            # پردازش job
+            active_jobs[worker_id] = job['job_id']
+            job_task = running_jobs[job['job_id']] = asyncio.create_task(process_job(job))
+            heartbeat = asyncio.create_task(lease_heartbeat(job['job_id'], lease_owner, job_task))
+            try:
+                await job_task
+            except asyncio.CancelledError:
+                # لغو خود worker (خاموش شدن سرویس) از لغو job جداست
+                if job['job_id'] in lost_leases:
+                    # صاحب فعلی lease نتیجه را ثبت می‌کند
+                    logger.info(f"↩️ Job abandoned after lease loss: {job['job_id']}")
+                elif job['job_id'] not in cancelled_jobs:
+                    raise
+                else:
+                    logger.info(f"🚫 Job cancelled: {job['job_id']}")
+                    await finish_job(job['job_id'], lease_owner, 'cancelled', 'cancelled by user')
+                    if job.get('status_message_id'):
+                        await edit_message(job['chat_id'], job['status_message_id'], "🚫 لغو شد")
+            except JobDeferred as e:
+                await defer_job(job, lease_owner, e.delay, e.priority, e.flight_key)
+            except Exception as e:
+                await finish_job(job['job_id'], lease_owner, 'failed', str(e)[:500])
+            else:
+                await finish_job(job['job_id'], lease_owner, 'done')
+            finally:
+                heartbeat.cancel()
+                active_jobs.pop(worker_id, None)
+                running_jobs.pop(job['job_id'], None)
+                cancelled_jobs.discard(job['job_id'])
+                lost_leases.discard(job['job_id'])
             
         except Exception as e:
             logger.error(f"Worker loop error: {e}")
             await asyncio.sleep(1)
 
+async def queue_maintenance_loop():
+    """برگرداندن lease های منقضی شده و پاکسازی job های قدیمی"""
+    while True:
+        await asyncio.sleep(max(LEASE_TIMEOUT / 3, 10))
+        try:
+            await requeue_leased_jobs(expired_only=True)
+            await purge_finished_jobs()
+            await purge_extract_cache()
+            await purge_worker_status()
+        except Exception as e:
+            logger.error(f"Queue maintenance error: {e}")
+
+def local_worker_status():
+    """وضعیت لحظه‌ای همین پروسه (worker ها، مراحل، تلگرام)"""
+    return {
+        'worker': WORKER_NAME,
+        'workers': len(worker_tasks),
+        'workers_alive': sum(1 for task in worker_tasks if not task.done()),
+        'active_jobs': len(active_jobs),
+        'stages': {name: limiter.snapshot() for name, limiter in stages.items()},
+        'ytdlp_pool': ytdlp_pool.snapshot() if ytdlp_pool else None,
+        'telegram': client_pool.is_connected(),
+        'telegram_sessions': client_pool.snapshot(),
+        'cache_hits': cache_stats['hits'],
+        'cache_misses': cache_stats['misses']
+    }
+
+async def publish_worker_status():
+    await db.execute('''
+        INSERT OR REPLACE INTO worker_status (worker, status, updated_at) VALUES (?, ?, ?)
+    ''', (WORKER_NAME, json.dumps(local_worker_status()), time.time()))
+
+async def get_worker_statuses():
+    """
+    وضعیت همه پروسه‌های زنده (از worker_status)
+    - این پروسه با مقدار لحظه‌ای به جای آخرین ردیف ذخیره شده
+    """
+    rows = await db.fetchall(
+        'SELECT worker, status FROM worker_status WHERE updated_at > ?',
+        (time.time() - 3 * WORKER_STATUS_INTERVAL,)
+    )
+    statuses = {row['worker']: json.loads(row['status']) for row in rows}
+    statuses[WORKER_NAME] = local_worker_status()
+    return list(statuses.values())
+
+async def worker_status_loop():
+    """انتشار دوره‌ای وضعیت پروسه برای /stats و /health پروسه API"""
+    while True:
+        try:
+            await publish_worker_status()
+        except Exception as e:
+            logger.warning(f"Failed to publish worker status: {e}")
+        await asyncio.sleep(WORKER_STATUS_INTERVAL)
+
+async def purge_worker_status():
+    # ردیف پروسه‌هایی که مدت‌هاست خاموش شده‌اند
+    await db.execute(
+        'DELETE FROM worker_status WHERE updated_at < ?', (time.time() - LEASE_TIMEOUT,)
+    )
+
+def start_workers(count=WORKER_COUNT):
+    """راه‌اندازی pool از worker ها"""
+    for worker_id in range(max(1, count)):
+        worker_tasks.append(asyncio.create_task(worker_loop(worker_id)))
+    logger.info(f"👷 {len(worker_tasks)} workers started")
+
+def notify_workers():
+    """
+    بیدار کردن worker_service بعد از ثبت job (بدون منتظر ماندن)
+    - worker هایی که این پیام را نگیرند در poll بعدی (QUEUE_POLL_INTERVAL) job را برمی‌دارند
+    """
+    if worker_tasks or not WORKER_URL:
+        return
+    
+    async def wake():
+        try:
+            timeout = aiohttp.ClientTimeout(total=2)
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.post(f"{WORKER_URL}/wake"):
+                    pass
+        except Exception as e:
+            logger.debug(f"Worker wake failed: {e}")
+    
+    task = asyncio.create_task(wake())
+    background_tasks.append(task)
+    task.add_done_callback(background_tasks.remove)
+
 # ===========================
 # 🌐 FastAPI Endpoints
 # ===========================
@@ -533,6 +2109,9 @@ class DownloadRequest(BaseModel):
 class CacheCheckRequest(BaseModel):
     url: str
 
+class CacheBatchRequest(BaseModel):
+    urls: List[str]
+
 # Auth
 def verify_token(authorization: str = Header(None)):
     if not authorization or not authorization.startswith('Bearer '):
@@ -543,12 +2122,12 @@ def verify_token(authorization: str = Header(None)):
         raise HTTPException(status_code=403, detail="Invalid token")
 
 # Endpoints
-@app.post("/download")
+@router.post("/download")
 async def queue_download(request: DownloadRequest, authorization: str = Header(None)):
     """افزودن job به صف"""
     verify_token(authorization)
     
-    job_id = f"job_{asyncio.get_event_loop().time()}"
+    job_id = f"job_{uuid.uuid4().hex[:16]}"
     
     job_data = {
         'job_id': job_id,
@@ -560,8 +2139,10 @@ async def queue_download(request: DownloadRequest, authorization: str = Header(N
         'file_info': request.file_info
     }
     
-    await job_queue.put(job_data)
-    queue_position = job_queue.qsize()
+    # hit کش در چند میلی‌ثانیه تمام می‌شود؛ پشت دانلودهای طولانی منتظر نمی‌ماند
+    priority = 1 if CACHE_HIT_PRIORITY and await is_cached(request.url) else 0
+    queue_position = await enqueue_job(job_data, priority)
+    notify_workers()
     
     logger.info(f"✅ Job queued: {job_id} (position: {queue_position})")
     
@@ -570,7 +2151,7 @@ async def queue_download(request: DownloadRequest, authorization: str = Header(N
         'queue_position': queue_position
     }
 
-@app.post("/api/cache/check")
+@router.post("/api/cache/check")
 async def check_cache(request: CacheCheckRequest, authorization: str = Header(None)):
     verify_token(authorization)
     
@@ -579,74 +2160,208 @@ async def check_cache(request: CacheCheckRequest, authorization: str = Header(No
     if cached:
         return {
             'cached': True,
-            **cached
+            **{key: value for key, value in cached.items() if key != 'handle'}
         }
     
     return {'cached': False}
 
-@app.get("/recent/{user_id}")
+@router.post("/api/cache/check/batch")
+async def check_cache_batch(request: CacheBatchRequest, authorization: str = Header(None)):
+    verify_token(authorization)
+    
+    if len(request.urls) > CACHE_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {CACHE_BATCH_MAX} urls per request")
+    
+    hits = await get_cached_files(request.urls)
+    
+    return {
+        'hits': hits,
+        'misses': [url for url in dict.fromkeys(request.urls) if url not in hits]
+    }
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str, authorization: str = Header(None)):
+    verify_token(authorization)
+    
+    status = await get_job_status(job_id)
+    if not status:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return status
+
+@router.delete("/jobs/{job_id}")
+async def delete_job(job_id: str, authorization: str = Header(None)):
+    """لغو job و آزاد کردن فوری اتصال‌ها و فایل‌های موقت آن"""
+    verify_token(authorization)
+    
+    state = await cancel_job(job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if state in ('done', 'failed'):
+        raise HTTPException(status_code=409, detail=f"Job already {state}")
+    
+    # job در همین پروسه است: بدون منتظر ماندن برای heartbeat متوقف می‌شود
+    job_task = running_jobs.get(job_id)
+    if state == 'cancelling' and job_task:
+        cancelled_jobs.add(job_id)
+        job_task.cancel()
+    
+    if state == 'cancelled':
+        cleanup_job_dir(job_download_dir(job_id))
+    
+    logger.info(f"🚫 Cancel requested: {job_id} ({state})")
+    
+    return {
+        'job_id': job_id,
+        'state': state
+    }
+
+@router.get("/recent/{user_id}")
 async def get_recent(user_id: int, authorization: str = Header(None)):
     verify_token(authorization)
     
-    with get_db() as conn:
-        results = conn.execute('''
-            SELECT url, filename, file_size, timestamp 
-            FROM user_history 
-            WHERE user_id = ? 
-            ORDER BY timestamp DESC 
-            LIMIT 5
-        ''', (user_id,)).fetchall()
-        
-        recent = [dict(row) for row in results]
-        
-        return {
-            'count': len(recent),
-            'recent': recent
-        }
+    results = await db.fetchall('''
+        SELECT url, filename, file_size, timestamp 
+        FROM user_history 
+        WHERE user_id = ? 
+        ORDER BY timestamp DESC 
+        LIMIT 5
+    ''', (user_id,))
+    
+    recent = [dict(row) for row in results]
+    
+    return {
+        'count': len(recent),
+        'recent': recent
+    }
+
+def sum_snapshots(snapshots):
+    """جمع مقادیر عددی snapshot های هم‌شکل پروسه‌های مختلف"""
+    total = {}
+    for snapshot in snapshots:
+        for key, value in snapshot.items():
+            total[key] = total.get(key, 0) + value
+    return total
 
-@app.get("/stats")
+@router.get("/stats")
 async def get_stats(authorization: str = Header(None)):
     verify_token(authorization)
     
-    with get_db() as conn:
-        cache_count = conn.execute('SELECT COUNT(*) as count FROM file_cache').fetchone()
-        user_count = conn.execute('SELECT COUNT(DISTINCT user_id) as count FROM user_history').fetchone()
-        
-        return {
-            'cache_size': cache_count['count'],
-            'total_users': user_count['count'],
-            'queue_size': job_queue.qsize(),
-            'active_jobs': 0,
-            'worker_alive': True
-        }
+    queue_counts = await get_queue_counts()
+    
+    cache_count = await db.fetchone('SELECT COUNT(*) as count FROM file_cache')
+    user_count = await db.fetchone('SELECT COUNT(DISTINCT user_id) as count FROM user_history')
+    
+    # در حالت جدا، worker ها در پروسه‌های دیگرند و وضعیتشان از دیتابیس خوانده می‌شود
+    statuses = await get_worker_statuses()
+    processing = [status for status in statuses if status['workers']]
+    hits = sum(status['cache_hits'] for status in statuses)
+    misses = sum(status['cache_misses'] for status in statuses)
+    pools = [status['ytdlp_pool'] for status in processing if status['ytdlp_pool']]
+    inflight = await db.fetchone('''
+        SELECT COUNT(DISTINCT flight_key) AS count FROM job_queue 
+        WHERE state = 'leased' AND flight_key IS NOT NULL
+    ''')
+    
+    return {
+        'cache_size': cache_count['count'],
+        'cache_hits': hits,
+        'cache_misses': misses,
+        'cache_hit_rate': round(hits / (hits + misses), 4) if hits + misses else None,
+        'total_users': user_count['count'],
+        'queue_size': queue_counts['queued'],
+        'queue': queue_counts,
+        'active_jobs': queue_counts['leased'],
+        'inflight_urls': inflight['count'],
+        'worker_processes': len(processing),
+        'workers': sum(status['workers'] for status in processing),
+        'worker_alive': any(status['workers_alive'] for status in processing),
+        'stages': {
+            name: sum_snapshots(status['stages'][name] for status in processing)
+            for name in stages
+        },
+        'disk': await get_disk_usage(),
+        'ytdlp_pool': sum_snapshots(pools) if pools else None,
+        'telegram_sessions': [
+            {**session, 'worker': status['worker']}
+            for status in processing for session in status['telegram_sessions']
+        ]
+    }
 
-@app.get("/health")
+@router.get("/metrics")
+async def get_metrics():
+    # مثل /health بدون توکن تا Prometheus بتواند scrape کند
+    queue_counts = await get_queue_counts()
+    for state, count in queue_counts.items():
+        metrics.QUEUE_DEPTH.labels(state).set(count)
+    for name, limiter in stages.items():
+        metrics.STAGE_SLOTS.labels(name, 'active').set(limiter.active)
+        metrics.STAGE_SLOTS.labels(name, 'waiting').set(limiter.waiting)
+    metrics.DISK_RESERVED.set((await get_disk_usage())['reserved'])
+    
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+@router.get("/health")
 async def health_check():
+    queue_counts = await get_queue_counts()
+    # تلگرام فقط در پروسه‌هایی که worker دارند وصل می‌شود
+    processing = [status for status in await get_worker_statuses() if status['workers']]
     return {
         "status": "ok",
         "database": os.path.exists(DATABASE_PATH),
-        "telegram": client is not None and client.is_connected(),
-        "queue_size": job_queue.qsize()
+        "telegram": any(status['telegram'] for status in processing),
+        "workers_alive": sum(status['workers_alive'] for status in processing),
+        "queue_size": queue_counts['queued']
     }
 
+app.include_router(router)
+
 # ===========================
 # 🚀 Startup
 # ===========================
 @app.on_event("startup")
 async def startup_event():
-    """راه‌اندازی اولیه"""
+    """راه‌اندازی اولیه (API و worker ها در یک پروسه)"""
     logger.info("🚀 Starting backend...")
     
     # راه‌اندازی دیتابیس
-    init_database()
+    await init_database()
+    
+    # job هایی که قبل از ری‌استارت در حال پردازش بودند دوباره به صف برمی‌گردند
+    await requeue_leased_jobs(expired_only=False)
     
+    await start_processing()
+    
+    logger.info("✅ Backend is ready!")
+
+async def start_worker_service():
+    """
+    راه‌اندازی یک پروسه worker جدا (worker_service.py)
+    - چند پروسه worker ممکن است همزمان از یک صف بخوانند، پس فقط lease های منقضی شده
+      برمی‌گردند (lease یک worker زنده با heartbeat تمدید می‌شود)
+    """
+    logger.info(f"🚀 Starting worker service {WORKER_NAME}...")
+    
+    await init_database()
+    await requeue_leased_jobs(expired_only=True)
+    await start_processing()
+    
+    logger.info("✅ Worker service is ready!")
+
+async def start_processing():
+    """تلگرام، yt-dlp و worker های پردازش job"""
     # راه‌اندازی تلگرام
     await start_client()
     
-    # شروع worker loop
-    asyncio.create_task(worker_loop())
+    # گرم کردن process های yt-dlp در پس‌زمینه
+    if ytdlp_pool:
+        background_tasks.append(asyncio.create_task(ytdlp_pool.start()))
     
-    logger.info("✅ Backend is ready!")
+    # شروع worker pool
+    start_workers()
+    background_tasks.append(asyncio.create_task(queue_maintenance_loop()))
+    background_tasks.append(asyncio.create_task(worker_status_loop()))
 
 # ===========================
 # Main
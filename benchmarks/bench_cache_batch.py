@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# bench_cache_batch.py - N درخواست تکی /api/cache/check در برابر یک درخواست /api/cache/check/batch
+#
+#   python benchmarks/bench_cache_batch.py --rows 50000 --urls 200 --rounds 20
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(), 'cache.db'))
+
+import backend  # noqa: E402
+from url_keys import canonical_key  # noqa: E402
+
+AUTH = 'Bearer bench'
+
+
+async def populate(rows):
+    def insert(conn):
+        conn.execute('DELETE FROM file_cache')
+        conn.executemany(
+            'INSERT INTO file_cache (url, file_id, file_type, filename, file_size) VALUES (?, ?, ?, ?, ?)',
+            ((canonical_key(f'https://example.com/file/{i}'), str(i), 'video', f'{i}.mp4', i) for i in range(rows))
+        )
+    await backend.db.run(insert)
+
+
+def sample_urls(rows, count):
+    # نیمی hit و نیمی miss، بعضی با query string که کلید canonical حذفش می‌کند
+    urls = []
+    for _ in range(count):
+        url = f'https://example.com/file/{random.randrange(rows * 2)}'
+        if random.random() < 0.3:
+            url += '?utm_source=bench'
+        urls.append(url)
+    return urls
+
+
+async def single_calls(urls):
+    """رفتار فعلی ربات: یک درخواست به ازای هر لینک (همزمان)"""
+    responses = await asyncio.gather(*(
+        backend.check_cache(backend.CacheCheckRequest(url=url), authorization=AUTH)
+        for url in urls
+    ))
+    return sum(1 for response in responses if response['cached'])
+
+
+async def batch_call(urls):
+    response = await backend.check_cache_batch(
+        backend.CacheBatchRequest(urls=urls), authorization=AUTH
+    )
+    return len(response['hits'])
+
+
+async def measure(fn, rows, count, rounds):
+    timings = []
+    hits = 0
+    for _ in range(rounds):
+        urls = sample_urls(rows, count)
+        started = time.perf_counter()
+        hits += await fn(urls)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {
+        'p50_ms': statistics.median(timings) * 1000,
+        'max_ms': timings[-1] * 1000,
+        'hits': hits
+    }
+
+
+def report(name, result):
+    print(
+        f"{name:<8} p50 {result['p50_ms']:>8.2f} ms  max {result['max_ms']:>8.2f} ms  "
+        f"hits {result['hits']}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--urls', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    await backend.init_database()
+    await populate(args.rows)
+    print(f"db={backend.DATABASE_PATH} rows={args.rows} urls/request={args.urls} rounds={args.rounds}")
+
+    await measure(batch_call, args.rows, args.urls, 2)  # گرم کردن thread ها و اتصال‌ها
+    random.seed(1)
+    report('single', await measure(single_calls, args.rows, args.urls, args.rounds))
+    random.seed(1)
+    report('batch', await measure(batch_call, args.rows, args.urls, args.rounds))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
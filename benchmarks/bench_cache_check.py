@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# bench_cache_check.py - تاخیر /api/cache/check زیر بار همزمان (قبل و بعد از pool دیتابیس)
+#
+#   python benchmarks/bench_cache_check.py --rows 50000 --concurrency 64 --requests 5000
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(), 'cache.db'))
+
+import backend  # noqa: E402
+from url_keys import canonical_key  # noqa: E402
+
+AUTH = 'Bearer bench'
+
+
+async def legacy_get_cached_file(url):
+    """پیاده‌سازی قبلی: اتصال تازه برای هر کوئری، روی خود event loop"""
+    conn = sqlite3.connect(backend.DATABASE_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    try:
+        result = conn.execute(
+            'SELECT * FROM file_cache WHERE url = ?', (canonical_key(url),)
+        ).fetchone()
+        if result:
+            return {
+                'file_id': result['file_id'],
+                'file_type': result['file_type'],
+                'filename': result['filename'],
+                'file_size': result['file_size']
+            }
+    finally:
+        conn.close()
+    return None
+
+
+async def populate(rows):
+    def insert(conn):
+        conn.execute('DELETE FROM file_cache')
+        conn.executemany(
+            'INSERT INTO file_cache (url, file_id, file_type, filename, file_size) VALUES (?, ?, ?, ?, ?)',
+            ((canonical_key(f'https://example.com/file/{i}'), str(i), 'video', f'{i}.mp4', i) for i in range(rows))
+        )
+    await backend.db.run(insert)
+
+
+async def run_load(rows, concurrency, requests):
+    latencies = []
+    lag = []
+    stop = asyncio.Event()
+
+    async def loop_lag_probe():
+        # تاخیر event loop همان چیزی است که بقیه درخواست‌ها حس می‌کنند
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lag.append(time.perf_counter() - start - 0.005)
+
+    async def lookup(issued_at):
+        # تاخیر از لحظه رسیدن درخواست (شامل صبر برای loop) تا پاسخ
+        url = f'https://example.com/file/{random.randrange(rows * 2)}'
+        await backend.check_cache(backend.CacheCheckRequest(url=url), authorization=AUTH)
+        latencies.append(time.perf_counter() - issued_at)
+
+    probe = asyncio.create_task(loop_lag_probe())
+    started = time.perf_counter()
+    for _ in range(max(1, requests // concurrency)):
+        issued_at = time.perf_counter()
+        await asyncio.gather(*(lookup(issued_at) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        'max_loop_lag_ms': max(lag or [0]) * 1000
+    }
+
+
+def report(name, result):
+    print(
+        f"{name:<8} {result['requests']:>7} req  {result['rps']:>9.0f} req/s  "
+        f"p50 {result['p50_ms']:>7.2f} ms  p99 {result['p99_ms']:>7.2f} ms  "
+        f"loop lag max {result['max_loop_lag_ms']:>7.2f} ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    await backend.init_database()
+    await populate(args.rows)
+    print(f"db={backend.DATABASE_PATH} rows={args.rows} concurrency={args.concurrency}")
+
+    pooled = backend.get_cached_file
+    backend.get_cached_file = legacy_get_cached_file
+    report('before', await run_load(args.rows, args.concurrency, args.requests))
+
+    backend.get_cached_file = pooled
+    await run_load(args.rows, args.concurrency, args.concurrency * 4)  # گرم کردن thread ها و اتصال‌ها
+    report('after', await run_load(args.rows, args.concurrency, args.requests))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
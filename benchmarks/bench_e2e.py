@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# bench_e2e.py - throughput کامل process_job بدون توکن ربات و اینترنت
+#
+# backend واقعی (صف، worker ها، دانلود، آپلود part به part) با این جایگزین‌ها اجرا می‌شود:
+#   - FakeTelegramClient: پهنای باند و تاخیر قابل تنظیم برای آپلود (یکی برای هر session)
+#   - fake_ytdlp.py: به جای yt-dlp فایل می‌سازد و progress واقعی چاپ می‌کند
+#   - origin محلی aiohttp با پشتیبانی Range برای لینک‌های مستقیم
+#
+#   python benchmarks/bench_e2e.py --jobs 40 --mix direct=6,ytdlp=3,repeat=1 --size-mb 20 \
+#       --workers 4 --upload-mbps 40 --latency-ms 50 --sessions 2
+
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import statistics
+from types import SimpleNamespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+AUTH = 'Bearer bench'
+BACKUP_CHANNEL_ID = -1000000000001
+PATTERN_SIZE = 1024 * 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=40)
+    parser.add_argument('--mix', default='direct=6,ytdlp=3,repeat=1',
+                        help='وزن انواع job: direct، ytdlp و repeat (لینک تکراری → کش)')
+    parser.add_argument('--size-mb', type=float, default=20)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='job در ثانیه؛ 0 یعنی همه با هم')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--upload-mbps', type=float, default=40,
+                        help='پهنای باند آپلود هر session تلگرام (MiB/s)')
+    parser.add_argument('--sessions', type=int, default=1,
+                        help='تعداد session های ClientPool (هر کدام اتصال جدا)')
+    parser.add_argument('--latency-ms', type=float, default=50,
+                        help='تاخیر هر درخواست MTProto')
+    parser.add_argument('--origin-mbps', type=float, default=0,
+                        help='سرعت هر اتصال origin (MiB/s)؛ 0 یعنی بدون محدودیت')
+    parser.add_argument('--ytdlp-mbps', type=float, default=0)
+    parser.add_argument('--disk-budget-mb', type=float, default=0,
+                        help='DISK_BUDGET برای پوشه دانلود؛ 0 یعنی پیش‌فرض backend')
+    parser.add_argument('--heavy-share', type=float, default=0,
+                        help='سهم job هایی که همه از یک کاربر سنگین می‌آیند (بقیه هر کدام کاربر جدا)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help='نمایش log های backend')
+    return parser.parse_args()
+
+
+def configure_environment(args, workdir):
+    """env قبل از import کردن backend تنظیم می‌شود (config در زمان import خوانده می‌شود)"""
+    bin_dir = os.path.join(workdir, 'bin')
+    os.makedirs(bin_dir)
+    shim = os.path.join(bin_dir, 'yt-dlp')
+    with open(shim, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(BENCH_DIR, "fake_ytdlp.py")}" "$@"\n')
+    os.chmod(shim, 0o755)
+
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_YTDLP_MBPS'] = str(args.ytdlp_mbps)
+    # fake_ytdlp یک CLI است؛ ytdlp_pool ماژول yt_dlp واقعی را import می‌کند
+    os.environ['YTDLP_WORKERS'] = '0'
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'cache.db')
+    os.environ['BACKUP_CHANNEL_ID'] = str(BACKUP_CHANNEL_ID)
+    os.environ['WORKER_COUNT'] = str(args.workers)
+    os.environ['QUEUE_POLL_INTERVAL'] = '0.2'
+    os.environ['ADMISSION_RETRY_DELAY'] = '0.5'
+    if args.disk_budget_mb:
+        os.environ['DISK_BUDGET'] = str(int(args.disk_budget_mb * 1024 * 1024))
+    # اتصال‌های MTProto اضافه به DC واقعی نیاز دارند؛ fake فقط اتصال اصلی را دارد
+    os.environ['UPLOAD_CONNECTIONS'] = '1'
+
+
+# ===========================
+# Fake Telegram
+# ===========================
+class Link:
+    """یک لینک مشترک با پهنای باند محدود (صف FIFO روی زمان)"""
+
+    def __init__(self, mbps, latency):
+        self.rate = mbps * 1024 * 1024 if mbps else 0
+        self.latency = latency
+        self.free_at = 0.0
+
+    async def transfer(self, size):
+        now = time.monotonic()
+        if self.rate:
+            self.free_at = max(now, self.free_at) + size / self.rate
+            await asyncio.sleep(self.free_at - now + self.latency)
+        else:
+            await asyncio.sleep(self.latency)
+
+
+class FakeTelegramClient:
+    """
+    فقط بخشی از TelegramClient که backend استفاده می‌کند
+    - send_file به چت کاربر (غیر از کانال پشتیبان) زمان تحویل job را ثبت می‌کند
+    - پیام‌ها مثل تلگرام واقعی بین همه session ها مشترک‌اند (messages)
+    """
+
+    def __init__(self, link, on_delivery, messages):
+        self.link = link
+        self.on_delivery = on_delivery
+        self.messages = messages
+        self.uploaded_bytes = 0
+
+    def is_connected(self):
+        return True
+
+    def _message(self, media=None):
+        message_id = len(self.messages) + 1
+        message = SimpleNamespace(id=message_id, media=media)
+        self.messages[message_id] = message
+        return message
+
+    async def __call__(self, request):
+        part = getattr(request, 'bytes', b'')
+        self.uploaded_bytes += len(part)
+        await self.link.transfer(len(part))
+        return True
+
+    async def upload_file(self, filepath, file_name=None, part_size_kb=512):
+        from telethon.tl.types import InputFile
+        size = os.path.getsize(filepath)
+        self.uploaded_bytes += size
+        await self.link.transfer(size)
+        return InputFile(random.getrandbits(62), max(1, -(-size // (part_size_kb * 1024))), file_name, '')
+
+    async def send_message(self, chat_id, text):
+        await self.link.transfer(0)
+        return self._message()
+
+    async def edit_message(self, chat_id, message_id, text):
+        await self.link.transfer(0)
+
+    async def send_file(self, chat_id, file, **kwargs):
+        await self.link.transfer(0)
+        document = SimpleNamespace(
+            id=random.getrandbits(62), access_hash=random.getrandbits(62), file_reference=b'bench'
+        )
+        message = self._message(SimpleNamespace(document=document))
+        if chat_id != BACKUP_CHANNEL_ID:
+            self.on_delivery(chat_id)
+        return message
+
+    async def get_messages(self, chat_id, ids):
+        await self.link.transfer(0)
+        return self.messages.get(ids)
+
+
+# ===========================
+# Local origin
+# ===========================
+def pattern_for(name):
+    return random.Random(name).randbytes(PATTERN_SIZE)
+
+
+async def start_origin(origin_mbps):
+    """سرور محلی: /files/<size>/<name> با HEAD و Range"""
+    from aiohttp import web
+
+    patterns = {}
+    rate = origin_mbps * 1024 * 1024
+
+    async def serve(request):
+        size = int(request.match_info['size'])
+        name = request.match_info['name']
+        pattern = patterns.setdefault(name, pattern_for(name))
+        headers = {'Accept-Ranges': 'bytes', 'Content-Type': 'application/octet-stream'}
+
+        start, end, status = 0, size - 1, 200
+        if 'Range' in request.headers:
+            first, last = request.headers['Range'].split('=', 1)[1].split('-')
+            start, end, status = int(first), min(int(last or size - 1), size - 1), 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        headers['Content-Length'] = str(end - start + 1)
+
+        if request.method == 'HEAD':
+            return web.Response(status=status, headers=headers)
+
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        offset = start
+        started = time.monotonic()
+        while offset <= end:
+            step = min(256 * 1024, end - offset + 1)
+            base = offset % PATTERN_SIZE
+            chunk = (pattern[base:] + pattern)[:step] if base + step > PATTERN_SIZE else pattern[base:base + step]
+            await response.write(chunk)
+            offset += step
+            if rate:
+                delay = (offset - start) / rate - (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_route('*', '/files/{size}/{name}', serve)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}'
+
+
+# ===========================
+# Job mix
+# ===========================
+def build_jobs(args, origin):
+    weights = dict(
+        (name, float(weight)) for name, weight in
+        (item.split('=') for item in args.mix.split(','))
+    )
+    rng = random.Random(args.seed)
+    size = int(args.size_mb * 1024 * 1024)
+    kinds = rng.choices(list(weights), weights=list(weights.values()), k=args.jobs)
+
+    urls = []
+    for index, kind in enumerate(kinds):
+        if kind == 'repeat' and urls:
+            urls.append(rng.choice(urls))
+        elif kind == 'ytdlp':
+            urls.append(f'https://www.youtube.com/watch?v=bench{index:06d}&bench_size={size}')
+        else:
+            urls.append(f'{origin}/files/{size}/file{index}.bin')
+    return kinds, urls
+
+
+class DiskSampler:
+    """بیشترین فضای اشغال شده در DOWNLOAD_PATH (بلوک‌های واقعی، نه حجم sparse)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.peak = 0
+
+    def usage(self):
+        total = 0
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                try:
+                    total += os.stat(os.path.join(root, name)).st_blocks * 512
+                except OSError:
+                    pass
+        return total
+
+    async def run(self, stop):
+        while not stop.is_set():
+            self.peak = max(self.peak, await asyncio.to_thread(self.usage))
+            await asyncio.sleep(0.05)
+
+
+async def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='tgup-bench-')
+    configure_environment(args, workdir)
+
+    import backend
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    backend.DOWNLOAD_PATH = os.path.join(workdir, 'downloads')
+    os.makedirs(backend.DOWNLOAD_PATH)
+    random.seed(args.seed)
+
+    enqueued_at = {}
+    delivery = {}
+
+    def on_delivery(chat_id):
+        if chat_id in enqueued_at and chat_id not in delivery:
+            delivery[chat_id] = time.perf_counter() - enqueued_at[chat_id]
+
+    messages = {}
+    fakes = []
+
+    async def fake_client(session_name):
+        fakes.append(FakeTelegramClient(Link(args.upload_mbps, args.latency_ms / 1000), on_delivery, messages))
+        return fakes[-1]
+
+    backend.client_pool = backend.ClientPool(fake_client, backend.session_names(args.sessions))
+
+    runner, origin = await start_origin(args.origin_mbps)
+    kinds, urls = build_jobs(args, origin)
+
+    await backend.startup_event()
+
+    stop = asyncio.Event()
+    disk = DiskSampler(backend.DOWNLOAD_PATH)
+    sampler = asyncio.create_task(disk.run(stop))
+
+    users = random.Random(args.seed)
+    heavy_chats = set()
+    started = time.perf_counter()
+    for index, url in enumerate(urls):
+        chat_id = 1000 + index
+        user_id = chat_id
+        if users.random() < args.heavy_share:
+            user_id = 1
+            heavy_chats.add(chat_id)
+        enqueued_at[chat_id] = time.perf_counter()
+        await backend.queue_download(
+            backend.DownloadRequest(url=url, chat_id=chat_id, user_id=user_id, message_id=1),
+            authorization=AUTH
+        )
+        if args.rate:
+            await asyncio.sleep(1 / args.rate)
+
+    while True:
+        counts = await backend.get_queue_counts()
+        if counts['queued'] == 0 and counts['leased'] == 0:
+            break
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await sampler
+    for task in backend.worker_tasks + backend.background_tasks:
+        task.cancel()
+    await runner.cleanup()
+
+    counts = await backend.get_queue_counts()
+    latencies = sorted(delivery.values())
+    mix = {kind: kinds.count(kind) for kind in sorted(set(kinds))}
+    # ru_maxrss روی لینوکس به KiB است (fake yt-dlp در پروسه جدا اجرا می‌شود و حساب نمی‌شود)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(f"jobs={args.jobs} mix={mix} size={args.size_mb}MiB workers={args.workers} "
+          f"upload={args.upload_mbps}MiB/s x {args.sessions} sessions latency={args.latency_ms}ms")
+    print(f"done {counts['done']}  failed {counts['failed']}  elapsed {elapsed:.1f}s  "
+          f"{counts['done'] / elapsed * 60:.1f} jobs/min")
+    if latencies:
+        print(f"time to delivery  p50 {statistics.median(latencies):.2f}s  "
+              f"p99 {latencies[max(0, int(len(latencies) * 0.99) - 1)]:.2f}s  max {latencies[-1]:.2f}s")
+    if heavy_chats:
+        light = sorted(latency for chat_id, latency in delivery.items() if chat_id not in heavy_chats)
+        heavy = sorted(latency for chat_id, latency in delivery.items() if chat_id in heavy_chats)
+        if light and heavy:
+            print(f"p50 time to delivery  light users {statistics.median(light):.2f}s  "
+                  f"heavy user {statistics.median(heavy):.2f}s ({len(heavy)} jobs)")
+    print(f"uploaded {sum(fake.uploaded_bytes for fake in fakes) / 1048576:.1f} MiB  "
+          f"peak disk {disk.peak / 1048576:.1f} MiB  "
+          f"peak rss {peak_rss / 1024:.1f} MiB")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
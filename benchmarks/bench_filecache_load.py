@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# bench_filecache_load.py - زمان load و هزینه هر set در database.FileCache
+# (فایل JSON کامل قدیمی در برابر log با append)
+#
+#   python benchmarks/bench_filecache_load.py --entries 100000 --writes 200
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime
+
+workdir = tempfile.mkdtemp()
+os.environ['CACHE_FILE'] = os.path.join(workdir, 'file_cache.json')
+os.environ['USER_HISTORY_FILE'] = os.path.join(workdir, 'user_history.json')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import database  # noqa: E402
+
+
+def make_entries(count):
+    now = datetime.now().isoformat()
+    return {
+        f'{i:032x}': {
+            'url': f'https://example.com/video/{i}',
+            'file_id': str(i),
+            'file_type': 'video',
+            'file_name': f'video_{i}.mp4',
+            'file_size': i * 1024,
+            'cached_at': now
+        }
+        for i in range(count)
+    }
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+async def bench_writes(cache, writes):
+    start = time.perf_counter()
+    for i in range(writes):
+        await cache.set(f'https://example.com/new/{i}', str(i), 'video', f'new_{i}.mp4', i)
+    return (time.perf_counter() - start) / writes
+
+
+def legacy_write(cache_dict, writes):
+    """رفتار قبلی: بازنویسی کامل فایل با indent=2 برای هر set"""
+    start = time.perf_counter()
+    for i in range(writes):
+        cache_dict[f'new{i}'] = {'url': f'https://example.com/new/{i}'}
+        with open(database.CACHE_FILE, 'w') as f:
+            json.dump(cache_dict, f, indent=2)
+    return (time.perf_counter() - start) / writes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--writes', type=int, default=200)
+    args = parser.parse_args()
+
+    entries = make_entries(args.entries)
+    size_mb = lambda: os.path.getsize(database.CACHE_FILE) / 1024 / 1024
+
+    # فرمت قدیمی
+    with open(database.CACHE_FILE, 'w') as f:
+        json.dump(entries, f, indent=2)
+    legacy_size = size_mb()
+    legacy_load = timed(lambda: json.load(open(database.CACHE_FILE)))
+    legacy_set = legacy_write(dict(entries), min(args.writes, 20))
+
+    # فرمت log (اولین load همان مهاجرت از فایل قدیمی است)
+    with open(database.CACHE_FILE, 'w') as f:
+        json.dump(entries, f, indent=2)
+    migrate = timed(database.FileCache)
+    cache = database.FileCache()
+    log_load = timed(cache.load)
+    log_size = size_mb()
+    log_set = asyncio.run(bench_writes(cache, args.writes))
+
+    print(f"entries={args.entries}")
+    print(f"legacy JSON   load {legacy_load * 1000:8.1f} ms  set {legacy_set * 1000:8.2f} ms  file {legacy_size:6.1f} MB")
+    print(f"append log    load {log_load * 1000:8.1f} ms  set {log_set * 1000:8.2f} ms  file {log_size:6.1f} MB")
+    print(f"migration from legacy file {migrate * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
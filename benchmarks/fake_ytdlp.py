@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# fake_ytdlp.py - جایگزین yt-dlp برای bench_e2e.py (بدون اینترنت)
+#
+# فقط آرگومان‌هایی که backend می‌فرستد را می‌فهمد:
+#   -o <template>، --print after_move:<...>، --dump-single-json (استخراج info)،
+#   --load-info-json <path> (دانلود از info کش شده) یا URL در آخر
+# حجم فایل از پارامتر bench_size در URL و سرعت از FAKE_YTDLP_MBPS خوانده می‌شود.
+# مثل yt-dlp واقعی با --print و --progress، خط‌های progress و بعد از آن JSON نهایی هر دو روی
+# stdout چاپ می‌شوند؛ stderr فقط برای خطاست.
+
+import json
+import os
+import sys
+import time
+from urllib.parse import parse_qs, urlsplit
+
+CHUNK_SIZE = 256 * 1024
+
+
+def parse_args(argv):
+    options = {'output': '%(title)s.%(ext)s', 'print': None, 'dump': '--dump-single-json' in argv}
+    options['url'] = argv[-1]
+    index = 0
+    while index < len(argv) - 1:
+        if argv[index] == '-o':
+            options['output'] = argv[index + 1]
+            index += 1
+        elif argv[index] == '--print':
+            options['print'] = argv[index + 1]
+            index += 1
+        elif argv[index] == '--load-info-json':
+            with open(argv[index + 1]) as f:
+                options['url'] = json.load(f)['webpage_url']
+            index += 1
+        index += 1
+    return options
+
+
+def main():
+    options = parse_args(sys.argv[1:])
+    query = parse_qs(urlsplit(options['url']).query)
+    size = int(query.get('bench_size', ['1048576'])[0])
+    exit_code = int(query.get('bench_exit', ['0'])[0])
+    title = query.get('v', ['video'])[0]
+    rate = float(os.getenv('FAKE_YTDLP_MBPS', '0')) * 1024 * 1024
+
+    if exit_code:
+        print(f"ERROR: [youtube] {title}: simulated failure", file=sys.stderr)
+        return exit_code
+
+    if options['dump']:
+        print(json.dumps({
+            'id': title,
+            'title': title,
+            'ext': 'mp4',
+            'webpage_url': options['url'],
+            'filesize': size,
+            'width': 1280,
+            'height': 720,
+            'duration': max(1, size // (256 * 1024))
+        }), flush=True)
+        return 0
+
+    filepath = options['output'].replace('%(title)s', title).replace('%(ext)s', 'mp4')
+    part_path = f"{filepath}.part"
+    started = time.monotonic()
+    written = 0
+    chunk = os.urandom(CHUNK_SIZE)
+
+    with open(part_path, 'wb') as f:
+        while written < size:
+            step = min(CHUNK_SIZE, size - written)
+            f.write(chunk[:step])
+            written += step
+            if rate:
+                delay = written / rate - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            elapsed = max(time.monotonic() - started, 1e-6)
+            print(
+                f"[download] {written * 100 / size:5.1f}% of {size / 1048576:.2f}MiB "
+                f"at {written / elapsed / 1048576:.2f}MiB/s",
+                flush=True
+            )
+    os.replace(part_path, filepath)
+
+    if options['print']:
+        print(json.dumps({
+            'filepath': filepath,
+            'ext': 'mp4',
+            'title': title,
+            'width': 1280,
+            'height': 720,
+            'duration': max(1, size // (256 * 1024))
+        }), flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# content_hash.py - hash محتوای فایل همزمان با دانلود (بدون خواندن دوباره از دیسک)
+
+import hashlib
+
+# hash محتوا = SHA-256 از پشت سر هم گذاشتن SHA-256 هر بلوک 4MB
+# با این تعریف بازه‌های دانلود موازی هم (هر کدام روی بلوک‌های خودش) قابل hash هستند
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def align_to_blocks(size):
+    """گرد کردن اندازه بازه به بالا تا مرز بلوک‌ها"""
+    return max(1, -(-size // HASH_BLOCK_SIZE)) * HASH_BLOCK_SIZE
+
+
+class BlockHasher:
+    """
+    hash بلوکی داده‌ای که به ترتیب دلخواه بلوک‌ها ولی داخل هر بلوک پشت سر هم می‌رسد
+    - update(offset, data) بعد از هر نوشتن روی فایل صدا زده می‌شود
+    - اگر داده‌ای خارج از ترتیب برسد hash نامعتبر می‌شود (hexdigest → None)
+    """
+
+    def __init__(self):
+        self.blocks = {}
+        self._open = {}
+        self.valid = True
+
+    def reset(self):
+        """شروع دوباره (وقتی دانلود از بایت صفر تکرار می‌شود)"""
+        self.__init__()
+
+    def update(self, offset, data):
+        view = memoryview(data)
+        while view and self.valid:
+            index, block_offset = divmod(offset, HASH_BLOCK_SIZE)
+            digest, filled = self._open.pop(index, (None, 0))
+            if index in self.blocks or block_offset != filled:
+                self.valid = False
+                return
+
+            take = min(HASH_BLOCK_SIZE - block_offset, len(view))
+            digest = digest or hashlib.sha256()
+            digest.update(view[:take])
+            filled += take
+            if filled == HASH_BLOCK_SIZE:
+                self.blocks[index] = digest.digest()
+            else:
+                self._open[index] = (digest, filled)
+
+            offset += take
+            view = view[take:]
+
+    def hexdigest(self):
+        if not self.valid:
+            return None
+        blocks = dict(self.blocks)
+        for index, (digest, _) in self._open.items():
+            blocks[index] = digest.digest()
+        # بلوک‌ها باید پیوسته باشند (فقط بلوک آخر می‌تواند ناقص باشد)
+        if sorted(blocks) != list(range(len(blocks))):
+            return None
+        if any(index != len(blocks) - 1 for index in self._open):
+            return None
+        return hashlib.sha256(b''.join(blocks[index] for index in range(len(blocks)))).hexdigest()
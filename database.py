@@ -2,16 +2,128 @@ import os
 import json
 import hashlib
 import asyncio
-import re
 from datetime import datetime
 from pathlib import Path
 
+from url_keys import KEY_VERSION, canonical_key
+
+# ===========================
+# Append-only Log
+# ===========================
+# فشرده‌سازی وقتی تعداد خط‌ها از این حد و دو برابر رکوردهای زنده بیشتر شود
+COMPACT_MIN_LINES = int(os.getenv('COMPACT_MIN_LINES', '1000'))
+
+class AppendOnlyLog:
+    """
+    ذخیره‌سازی log-structured (هر خط یک رکورد JSON)
+    - هر تغییر فقط یک خط به انتهای فایل اضافه می‌کند: O(1)
+    - موقع load خط‌ها replay می‌شوند و index در حافظه ساخته می‌شود
+    - فشرده‌سازی در فایل موقت انجام و با rename اتمیک جایگزین می‌شود
+    - خط ناقص (crash وسط نوشتن) موقع replay نادیده گرفته می‌شود
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.lines = 0
+        self._file = None
+    
+    def is_legacy(self):
+        """فایل قدیمی که با json.dump(indent=2) کامل نوشته شده بود"""
+        try:
+            with open(self.path, 'r') as f:
+                return f.readline().strip() in ('{', '{}')
+        except FileNotFoundError:
+            return False
+    
+    def replay(self):
+        self.lines = 0
+        if not os.path.exists(self.path):
+            return
+        
+        with open(self.path, 'r') as f:
+            data = f.read()
+        
+        # مسیر سریع: همه خط‌ها با یک json.loads (رشته‌های JSON شامل \n خام نیستند)
+        try:
+            records = json.loads('[' + ','.join(data.splitlines()) + ']')
+        except ValueError:
+            records = None
+        
+        if records is not None:
+            self.lines = len(records)
+            yield from records
+            return
+        
+        for line in data.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print(f"⚠️ Skipping corrupt log line in {self.path}")
+                continue
+            self.lines += 1
+            yield record
+    
+    def _has_partial_line(self):
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                return f.read(1) != b'\n'
+        except OSError:
+            return False
+    
+    def append(self, record):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            partial = self._has_partial_line()
+            self._file = open(self.path, 'a')
+            # خط نیمه‌کاره قبلی نباید رکورد جدید را هم خراب کند
+            if partial:
+                self._file.write('\n')
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._file.flush()
+        self.lines += 1
+    
+    def needs_compaction(self, live_records):
+        return self.lines > max(COMPACT_MIN_LINES, 2 * live_records)
+    
+    def rewrite(self, records):
+        """نوشتن فقط رکوردهای زنده و جایگزینی اتمیک فایل"""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        lines = 0
+        with open(tmp_path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(',', ':')) + '\n')
+                lines += 1
+            f.flush()
+            os.fsync(f.fileno())
+        
+        self.close()
+        os.replace(tmp_path, self.path)
+        self.lines = lines
+    
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
 # ===========================
 # File Cache
 # ===========================
 CACHE_FILE = os.getenv('CACHE_FILE', '/tmp/file_cache.json')
 cache_lock = asyncio.Lock()
 
+def encode_media(media):
+    """handle سند تلگرام به شکل قابل ذخیره در JSON (file_reference به hex)"""
+    if not media:
+        return None
+    return dict(media, file_reference=media['file_reference'].hex())
+
+def decode_media(media):
+    if not media:
+        return None
+    return dict(media, file_reference=bytes.fromhex(media['file_reference']))
+
 class FileCache:
     """
     مدیریت cache فایل‌ها
@@ -21,35 +133,70 @@ class FileCache:
     
     def __init__(self):
         self.cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.log = AppendOnlyLog(CACHE_FILE)
         self.load()
     
     def _url_hash(self, url):
-        """تولید hash برای URL"""
-        # نرمال‌سازی URL - حذف query params
-        normalized_url = re.sub(r'\?.*$', '', url)
-        return hashlib.md5(normalized_url.encode()).hexdigest()
+        """تولید hash برای کلید canonical لینک (extractor + شناسه مدیا)"""
+        return hashlib.md5(canonical_key(url).encode()).hexdigest()
+    
+    def _rekey(self):
+        """مهاجرت entry ها به کلید canonical؛ از چند entry هم‌کلید جدیدترین می‌ماند"""
+        entries = sorted(self.cache.values(), key=lambda entry: entry.get('cached_at', ''))
+        self.cache = {self._url_hash(entry['url']): entry for entry in entries}
     
     def load(self):
-        """بارگذاری cache از فایل"""
+        """بارگذاری cache از فایل (replay کردن log)"""
         try:
-            if os.path.exists(CACHE_FILE):
+            if not os.path.exists(CACHE_FILE):
+                self.cache = {}
+                print("📝 New cache created")
+                return
+            
+            key_version = 0
+            if self.log.is_legacy():
+                # تبدیل فایل JSON قدیمی به log
                 with open(CACHE_FILE, 'r') as f:
                     self.cache = json.load(f)
-                print(f"✅ Cache loaded: {len(self.cache)} entries")
             else:
                 self.cache = {}
-                print("📝 New cache created")
+                for record in self.log.replay():
+                    if record.get('op') == 'set':
+                        self.cache[record['key']] = record['entry']
+                    elif record.get('op') == 'del':
+                        self.cache.pop(record['key'], None)
+                    elif record.get('op') == 'meta':
+                        key_version = record.get('key_version', 0)
+            
+            if key_version < KEY_VERSION:
+                self._rekey()
+                self.save()
+            
+            print(f"✅ Cache loaded: {len(self.cache)} entries")
         except Exception as e:
             print(f"⚠️ Cache load error: {e}")
             self.cache = {}
     
     def save(self):
-        """ذخیره cache در فایل"""
+        """فشرده‌سازی: بازنویسی log فقط با entry های زنده"""
         try:
-            os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
-            with open(CACHE_FILE, 'w') as f:
-                json.dump(self.cache, f, indent=2)
-            print(f"💾 Cache saved: {len(self.cache)} entries")
+            records = [{'op': 'meta', 'key_version': KEY_VERSION}]
+            records.extend(
+                {'op': 'set', 'key': key, 'entry': entry}
+                for key, entry in self.cache.items()
+            )
+            self.log.rewrite(records)
+            print(f"💾 Cache compacted: {len(self.cache)} entries")
+        except Exception as e:
+            print(f"⚠️ Cache save error: {e}")
+    
+    def _append(self, record):
+        try:
+            self.log.append(record)
+            if self.log.needs_compaction(len(self.cache)):
+                self.save()
         except Exception as e:
             print(f"⚠️ Cache save error: {e}")
     
@@ -69,17 +216,20 @@ class FileCache:
                 if days_old > 30:
                     print(f"⚠️ Cache expired for {url[:50]}...")
                     del self.cache[url_hash]
-                    self.save()
+                    self._append({'op': 'del', 'key': url_hash})
+                    self.misses += 1
                     return None
                 
                 print(f"✅ Cache HIT: {url[:50]}...")
+                self.hits += 1
                 return entry
             
             print(f"❌ Cache MISS: {url[:50]}...")
+            self.misses += 1
             return None
     
-    async def set(self, url, file_id, file_type, file_name, file_size):
-        """ذخیره file_id در cache"""
+    async def set(self, url, file_id, file_type, file_name, file_size, media=None):
+        """ذخیره file_id (و handle سند تلگرام) در cache"""
         async with cache_lock:
             url_hash = self._url_hash(url)
             
@@ -89,12 +239,23 @@ class FileCache:
                 'file_type': file_type,
                 'file_name': file_name,
                 'file_size': file_size,
+                'media': encode_media(media),
                 'cached_at': datetime.now().isoformat()
             }
             
-            self.save()
+            self._append({'op': 'set', 'key': url_hash, 'entry': self.cache[url_hash]})
             print(f"💾 Cached: {file_name} ({file_id})")
     
+    async def update_media(self, url, media):
+        """جایگزینی handle منقضی شده (file reference جدید)"""
+        async with cache_lock:
+            url_hash = self._url_hash(url)
+            
+            if url_hash in self.cache:
+                entry = dict(self.cache[url_hash], media=encode_media(media))
+                self.cache[url_hash] = entry
+                self._append({'op': 'set', 'key': url_hash, 'entry': entry})
+    
     async def delete(self, url):
         """حذف از cache"""
         async with cache_lock:
@@ -102,7 +263,7 @@ class FileCache:
             
             if url_hash in self.cache:
                 del self.cache[url_hash]
-                self.save()
+                self._append({'op': 'del', 'key': url_hash})
                 print(f"🗑️ Deleted from cache: {url[:50]}...")
                 return True
             
@@ -116,9 +277,14 @@ class FileCache:
                 for entry in self.cache.values()
             )
             
+            lookups = self.hits + self.misses
+            
             return {
                 'total_entries': len(self.cache),
                 'total_size': total_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
                 'entries': list(self.cache.values())
             }
 
@@ -129,6 +295,7 @@ file_cache = FileCache()
 # User History
 # ===========================
 USER_HISTORY_FILE = os.getenv('USER_HISTORY_FILE', '/tmp/user_history.json')
+HISTORY_LIMIT = 50
 history_lock = asyncio.Lock()
 
 class UserHistory:
@@ -136,25 +303,43 @@ class UserHistory:
     
     def __init__(self):
         self.history = {}
+        self.entries = 0
+        self.log = AppendOnlyLog(USER_HISTORY_FILE)
         self.load()
     
     def load(self):
         try:
-            if os.path.exists(USER_HISTORY_FILE):
+            if not os.path.exists(USER_HISTORY_FILE):
+                self.history = {}
+                return
+            
+            if self.log.is_legacy():
                 with open(USER_HISTORY_FILE, 'r') as f:
                     self.history = json.load(f)
-                print(f"✅ History loaded: {len(self.history)} users")
+                self.save()
             else:
                 self.history = {}
+                for record in self.log.replay():
+                    entries = self.history.setdefault(record['user'], [])
+                    entries.append(record['entry'])
+                    if len(entries) > HISTORY_LIMIT:
+                        del entries[:-HISTORY_LIMIT]
+            
+            self.entries = sum(len(entries) for entries in self.history.values())
+            print(f"✅ History loaded: {len(self.history)} users")
         except Exception as e:
             print(f"⚠️ History load error: {e}")
             self.history = {}
+            self.entries = 0
     
     def save(self):
+        """فشرده‌سازی: بازنویسی log فقط با entry های نگه‌داشته شده"""
         try:
-            os.makedirs(os.path.dirname(USER_HISTORY_FILE), exist_ok=True)
-            with open(USER_HISTORY_FILE, 'w') as f:
-                json.dump(self.history, f, indent=2)
+            self.log.rewrite(
+                {'user': user_id_str, 'entry': entry}
+                for user_id_str, entries in self.history.items()
+                for entry in entries
+            )
         except Exception as e:
             print(f"⚠️ History save error: {e}")
     
@@ -167,19 +352,27 @@ class UserHistory:
                 self.history[user_id_str] = []
             
             # اضافه کردن entry جدید
-            self.history[user_id_str].append({
+            entry = {
                 'url': url,
                 'file_id': file_id,
                 'file_name': file_name,
                 'file_size': file_size,
                 'timestamp': datetime.now().isoformat()
-            })
+            }
+            self.history[user_id_str].append(entry)
+            self.entries += 1
             
             # نگه‌داشتن فقط 50 آخر
-            if len(self.history[user_id_str]) > 50:
-                self.history[user_id_str] = self.history[user_id_str][-50:]
+            if len(self.history[user_id_str]) > HISTORY_LIMIT:
+                self.history[user_id_str] = self.history[user_id_str][-HISTORY_LIMIT:]
+                self.entries -= 1
             
-            self.save()
+            try:
+                self.log.append({'user': user_id_str, 'entry': entry})
+                if self.log.needs_compaction(self.entries):
+                    self.save()
+            except Exception as e:
+                print(f"⚠️ History save error: {e}")
     
     async def get_recent(self, user_id, limit=5):
         """دریافت لینک‌های اخیر کاربر"""
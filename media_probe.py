@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# media_probe.py - گرفتن ابعاد و مدت ویدیو بدون بلاک کردن event loop
+
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+EMPTY_INFO = {'width': 0, 'height': 0, 'duration': 0}
+
+
+def normalize_info(info):
+    """تبدیل خروجی yt-dlp / ffprobe به {'width', 'height', 'duration'}"""
+    if not info:
+        return None
+    try:
+        return {
+            'width': int(info.get('width') or 0),
+            'height': int(info.get('height') or 0),
+            'duration': int(float(info.get('duration') or 0))
+        }
+    except (TypeError, ValueError):
+        return None
+
+
+class ProbeService:
+    """
+    اجرای ffprobe با asyncio subprocess
+    - تعداد probe همزمان با limiter محدود می‌شود
+    - نتیجه بر اساس (مسیر، حجم، mtime) نگه داشته می‌شود تا یک فایل دوبار probe نشود
+    - اگر yt-dlp ابعاد و مدت را داده باشد اصلا ffprobe اجرا نمی‌شود
+    """
+
+    def __init__(self, limiter=None, max_entries=1024):
+        self.limiter = limiter
+        self.max_entries = max_entries
+        self._memo = OrderedDict()
+
+    def _key(self, filepath):
+        # URL ها (حالت استریم) stat ندارند
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return (filepath, None, None)
+        return (filepath, stat.st_size, stat.st_mtime_ns)
+
+    def _store(self, key, info):
+        self._memo[key] = info
+        self._memo.move_to_end(key)
+        while len(self._memo) > self.max_entries:
+            self._memo.popitem(last=False)
+
+    def remember(self, filepath, info):
+        """ثبت اطلاعاتی که از قبل معلوم است (مثلا info JSON خود yt-dlp)"""
+        info = normalize_info(info)
+        if info and info['duration'] > 0:
+            self._store(self._key(filepath), info)
+        return info
+
+    async def probe(self, filepath, known=None):
+        info = normalize_info(known)
+        if info and info['duration'] > 0:
+            return info
+
+        key = self._key(filepath)
+        if key in self._memo:
+            self._memo.move_to_end(key)
+            return self._memo[key]
+
+        async with self.limiter or nullcontext():
+            info = await self._run_ffprobe(filepath)
+
+        if info is not EMPTY_INFO:
+            self._store(key, info)
+        return info
+
+    async def _run_ffprobe(self, filepath):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                '-show_entries', 'stream=width,height,duration:format=duration',
+                '-of', 'json', filepath,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            try:
+                stdout, _ = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                raise
+            data = json.loads(stdout or b'{}')
+        except (OSError, ValueError) as e:
+            logger.warning(f"ffprobe failed for {filepath}: {e}")
+            return EMPTY_INFO
+
+        stream = (data.get('streams') or [{}])[0]
+        # mkv / webm مدت را فقط در format دارند
+        if not stream.get('duration'):
+            stream['duration'] = data.get('format', {}).get('duration')
+        return normalize_info(stream) or EMPTY_INFO
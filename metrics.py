@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# metrics.py - متریک‌های Prometheus (صف، مراحل job، حجم، کش، yt-dlp، flood wait)
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# از چند میلی‌ثانیه (کوئری کش) تا یک ساعت (دانلود/آپلود فایل 2GB)
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+    60, 120, 300, 600, 1200, 1800, 3600
+)
+
+QUEUE_DEPTH = Gauge(
+    'tgup_queue_jobs', 'Jobs in the durable queue', ['state']
+)
+QUEUE_WAIT = Histogram(
+    'tgup_queue_wait_seconds', 'Time from enqueue to first lease',
+    ['url_type'], buckets=DURATION_BUCKETS
+)
+STAGE_DURATION = Histogram(
+    'tgup_stage_duration_seconds', 'Duration of each job stage',
+    ['stage', 'url_type'], buckets=DURATION_BUCKETS
+)
+STAGE_SLOTS = Gauge(
+    'tgup_stage_slots', 'Active and waiting tasks per stage limiter', ['stage', 'status']
+)
+DISK_RESERVED = Gauge(
+    'tgup_disk_reserved_bytes', 'Download directory space reserved by running jobs'
+)
+DOWNLOADED_BYTES = Counter(
+    'tgup_downloaded_bytes_total', 'Bytes downloaded from origins', ['url_type']
+)
+UPLOADED_BYTES = Counter(
+    'tgup_uploaded_bytes_total', 'Bytes uploaded to Telegram', ['url_type']
+)
+CACHE_LOOKUPS = Counter(
+    'tgup_cache_lookups_total', 'Cache lookups by result', ['url_type', 'result']
+)
+EXTRACT_CACHE_LOOKUPS = Counter(
+    'tgup_extract_cache_lookups_total', 'yt-dlp extraction cache lookups by result', ['result']
+)
+YTDLP_EXITS = Counter(
+    'tgup_ytdlp_exits_total', 'yt-dlp process exit codes', ['url_type', 'code']
+)
+FLOOD_WAITS = Counter(
+    'tgup_telegram_flood_waits_total', 'FloodWait errors returned by Telegram', ['operation']
+)
+FLOOD_WAIT_SECONDS = Counter(
+    'tgup_telegram_flood_wait_seconds_total', 'Seconds Telegram asked us to wait', ['operation']
+)
+
+
+def stage_timer(stage, url_type):
+    """context manager برای اندازه‌گیری مدت یک مرحله"""
+    return STAGE_DURATION.labels(stage, url_type).time()
+
+
+def record_flood_wait(operation, seconds):
+    FLOOD_WAITS.labels(operation).inc()
+    FLOOD_WAIT_SECONDS.labels(operation).inc(seconds)
+
+
+def render():
+    """خروجی متنی برای endpoint /metrics: (body, content type)"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -1,6 +1,11 @@
 #!/bin/bash
 
-# start.sh - اجرای API Server و Worker Service
+# start.sh - اجرای API Server و Worker Service ها
+# همه از یک صف SQLite مشترک (DATABASE_PATH) استفاده می‌کنند
+# رزرو دیسک (DISK_BUDGET) و single-flight لینک‌ها هم در همان صف است و بین همه worker ها مشترک است
+
+WORKER_PROCESSES=${WORKER_PROCESSES:-1}
+BASE_WORKER_PORT=${WORKER_PORT:-9000}
 
 echo "🚀 Starting services..."
 
@@ -9,17 +14,24 @@ python api_server.py &
 API_PID=$!
 echo "✅ API Server started (PID: $API_PID)"
 
-# صبر کمی
+# صبر کمی (ساخت جدول‌ها و migration توسط API)
 sleep 2
 
-# راه‌اندازی Worker Service
-python worker_service.py &
-WORKER_PID=$!
-echo "✅ Worker Service started (PID: $WORKER_PID)"
+# راه‌اندازی Worker Service ها؛ هر کدام پورت و فایل session تلگرام خودش را دارد
+PIDS=($API_PID)
+for ((i = 0; i < WORKER_PROCESSES; i++)); do
+    SESSION=bot_session
+    if [ "$i" -gt 0 ]; then
+        SESSION=bot_session_w$i
+    fi
+    WORKER_PORT=$((BASE_WORKER_PORT + i)) TELEGRAM_SESSION=$SESSION python worker_service.py &
+    PIDS+=($!)
+    echo "✅ Worker Service $i started (PID: $!, port: $((BASE_WORKER_PORT + i)))"
+done
 
 echo "🎉 All services are running!"
-echo "   - API Server: http://0.0.0.0:8000"
-echo "   - Worker Service: http://0.0.0.0:9000"
+echo "   - API Server: http://0.0.0.0:${PORT:-8000}"
+echo "   - Worker Services: $WORKER_PROCESSES (from port $BASE_WORKER_PORT)"
 
 # نگه داشتن container
-wait $API_PID $WORKER_PID
+wait "${PIDS[@]}"
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# telegram_pool.py - چند session تلگرام برای همان bot (هر کدام یک اتصال MTProto جدا)
+
+import asyncio
+import contextvars
+import logging
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# session ای که job فعلی به آن سپرده شده (task های فرزند job هم همین را می‌بینند)
+_current_session = contextvars.ContextVar('telegram_session', default=None)
+
+
+def session_names(count, base='bot_session'):
+    """نام فایل session ها؛ اولی همان session قبلی است تا auth key موجود دوباره استفاده شود"""
+    return [base] + [f"{base}_{index}" for index in range(2, max(1, count) + 1)]
+
+
+class _Session:
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.jobs = 0
+        self.flood_until = 0
+
+    @property
+    def flood_wait(self):
+        return max(0, self.flood_until - time.monotonic())
+
+
+class ClientPool:
+    """
+    چند TelegramClient با session های جدا برای یک bot
+    - هر job به session با کمترین job فعال که در flood wait نیست سپرده می‌شود
+      و همه درخواست‌های آن job (آپلود، ارسال، ویرایش) از همان session می‌روند
+      (InputFile آپلود شده فقط برای همان session معتبر است)
+    - flood wait هر session جدا ثبت می‌شود و تا تمام شدنش job جدید نمی‌گیرد
+    - factory(name) یک client وصل شده برمی‌گرداند (در تست‌ها client جعلی)
+    """
+
+    def __init__(self, factory, names):
+        self.factory = factory
+        self.names = list(names)
+        self.sessions = []
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        """اتصال session ها (فقط بار اول یا بعد از قطع شدن همه)"""
+        if self.is_connected():
+            return
+        async with self._lock:
+            if self.is_connected():
+                return
+            self.sessions = []
+            for name in self.names:
+                try:
+                    self.sessions.append(_Session(name, await self.factory(name)))
+                except Exception as e:
+                    # session اصلی باید وصل شود؛ بقیه اختیاری هستند
+                    if not self.sessions:
+                        raise
+                    logger.warning(f"Telegram session {name} unavailable: {e}")
+            logger.info(f"✅ Telegram sessions connected: {len(self.sessions)}")
+
+    def is_connected(self):
+        return any(session.client.is_connected() for session in self.sessions)
+
+    def _pick(self):
+        sessions = [session for session in self.sessions if session.client.is_connected()] or self.sessions
+        return min(sessions, key=lambda session: (session.flood_wait > 0, session.jobs, session.flood_until))
+
+    @property
+    def client(self):
+        """client همین job، یا session با کمترین بار برای درخواست‌های خارج از job"""
+        session = _current_session.get()
+        return session.client if session else self._pick().client
+
+    @asynccontextmanager
+    async def assign(self):
+        """سپردن job فعلی به یک session تا پایان context"""
+        await self.start()
+        session = self._pick()
+        session.jobs += 1
+        token = _current_session.set(session)
+        try:
+            yield session
+        finally:
+            _current_session.reset(token)
+            session.jobs -= 1
+
+    def snapshot(self):
+        return [
+            {
+                'name': session.name,
+                'connected': session.client.is_connected(),
+                'jobs': session.jobs,
+                'flood_wait': round(session.flood_wait, 1)
+            }
+            for session in self.sessions
+        ]
+
+
+def note_flood_wait(seconds):
+    """ثبت FloodWait برای session همین job (خارج از job اثری ندارد)"""
+    session = _current_session.get()
+    if session:
+        session.flood_until = max(session.flood_until, time.monotonic() + seconds)
+        logger.warning(f"⏳ Session {session.name} in flood wait for {seconds}s")
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# telegram_upload.py - آپلود part به part فایل به تلگرام (MTProto)
+
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import random
+
+from telethon.errors import FloodWaitError
+from telethon.network import MTProtoSender
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.tl.types import InputDocument, InputFile, InputFileBig, InputMediaDocument
+
+from metrics import record_flood_wait
+from telegram_pool import note_flood_wait
+
+logger = logging.getLogger(__name__)
+
+# محدودیت‌های تلگرام برای آپلود
+PART_SIZE = 512 * 1024
+BIG_FILE_THRESHOLD = 10 * 1024 * 1024
+MAX_PARTS = 4000
+PART_RETRIES = 3
+# FloodWait خطا نیست و تلاش حساب نمی‌شود، ولی بی‌نهایت هم صبر نمی‌کنیم
+PART_FLOOD_WAITS = 5
+
+
+class UploadSizeMismatch(Exception):
+    """حجم داده دریافتی با حجم اعلام شده یکی نیست"""
+
+
+def _new_file_id():
+    return random.randrange(-2 ** 63, 2 ** 63)
+
+
+def _check_part_size(part_size):
+    # تلگرام فقط part هایی را قبول می‌کند که 512KB بر آن‌ها بخش‌پذیر باشد
+    if part_size % 1024 or PART_SIZE % part_size:
+        raise ValueError(f"Invalid upload part size: {part_size}")
+
+
+class SenderPool:
+    """
+    چند اتصال MTProto موازی به DC اصلی client
+    - اتصال اصلی client همیشه عضو pool است
+    - اگر ساخت اتصال اضافه ممکن نباشد فقط از client استفاده می‌شود
+    """
+
+    def __init__(self, client, connections=1):
+        self.client = client
+        self.connections = max(1, connections)
+        self._senders = []
+        self._next = 0
+
+    async def __aenter__(self):
+        for _ in range(self.connections - 1):
+            try:
+                self._senders.append(await self._open_sender())
+            except Exception as e:
+                logger.warning(f"Extra upload sender unavailable: {e}")
+                break
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        for sender in self._senders:
+            try:
+                await sender.disconnect()
+            except Exception:
+                pass
+        self._senders = []
+
+    async def _open_sender(self):
+        # مثل اتصال‌های borrow شده خود Telethon، ولی با همان auth key
+        client = self.client
+        dc = await client._get_dc(client.session.dc_id)
+        sender = MTProtoSender(client.session.auth_key, loggers=client._log)
+        await sender.connect(client._connection(
+            dc.ip_address,
+            dc.port,
+            dc.id,
+            loggers=client._log,
+            proxy=client._proxy,
+            local_addr=client._local_addr
+        ))
+        return sender
+
+    @property
+    def size(self):
+        return 1 + len(self._senders)
+
+    async def invoke(self, request, slot=None):
+        if slot is None:
+            slot = self._next
+            self._next += 1
+        slot %= self.size
+        if slot == 0:
+            return await self.client(request)
+        return await self._senders[slot - 1].send(request)
+
+
+async def _send_part(senders, request, slot):
+    """
+    ارسال یک part با تکرار در صورت FloodWait یا خطای گذرا
+    - فقط با موفقیت برمی‌گردد؛ در غیر این صورت خطا می‌دهد تا فایل ناقص ساخته نشود
+    """
+    attempt = 0
+    flood_waits = 0
+    while True:
+        try:
+            if await senders.invoke(request, slot):
+                return
+            error = Exception("Telegram rejected the part")
+        except FloodWaitError as e:
+            flood_waits += 1
+            if flood_waits > PART_FLOOD_WAITS:
+                raise
+            logger.warning(f"⏳ Flood wait {e.seconds}s while uploading")
+            record_flood_wait('upload_part', e.seconds)
+            note_flood_wait(e.seconds)
+            await asyncio.sleep(e.seconds)
+            continue
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            error = e
+
+        if attempt == PART_RETRIES:
+            raise error
+        attempt += 1
+        await asyncio.sleep(attempt)
+
+
+def _part_request(file_id, index, total_parts, part, is_big):
+    if is_big:
+        return SaveBigFilePartRequest(file_id, index, total_parts, part)
+    return SaveFilePartRequest(file_id, index, part)
+
+
+def _input_file(file_id, total_parts, file_name, is_big, md5=None):
+    if is_big:
+        return InputFileBig(file_id, total_parts, file_name)
+    return InputFile(file_id, total_parts, file_name, md5.hexdigest() if md5 else '')
+
+
+async def upload_file(client, filepath, file_name=None, part_size=PART_SIZE,
+                      connections=1, parallel=4, progress_callback=None):
+    """
+    آپلود فایل روی دیسک با چند part همزمان
+    خروجی: InputFile / InputFileBig قابل استفاده در client.send_file
+    """
+    _check_part_size(part_size)
+    file_name = file_name or os.path.basename(filepath)
+    file_size = os.path.getsize(filepath)
+    total_parts = math.ceil(file_size / part_size)
+    if total_parts > MAX_PARTS:
+        raise ValueError(f"File too large for Telegram: {file_size} bytes")
+
+    # فایل‌های کوچک md5 لازم دارند و موازی‌سازی سودی ندارد
+    if file_size <= BIG_FILE_THRESHOLD:
+        return await client.upload_file(filepath, file_name=file_name, part_size_kb=part_size // 1024)
+
+    file_id = _new_file_id()
+    indexes = asyncio.Queue()
+    for index in range(total_parts):
+        indexes.put_nowait(index)
+
+    uploaded = 0
+    fd = os.open(filepath, os.O_RDONLY)
+
+    async def send_parts(slot, senders):
+        nonlocal uploaded
+        while not indexes.empty():
+            index = indexes.get_nowait()
+            part = await asyncio.to_thread(os.pread, fd, part_size, index * part_size)
+            request = _part_request(file_id, index, total_parts, part, True)
+            await _send_part(senders, request, slot)
+
+            uploaded += len(part)
+            if progress_callback:
+                await progress_callback(uploaded, file_size)
+
+    try:
+        async with SenderPool(client, connections) as senders:
+            await _run_all([send_parts(slot, senders) for slot in range(max(1, parallel))])
+    finally:
+        os.close(fd)
+
+    return _input_file(file_id, total_parts, file_name, True)
+
+
+async def upload_stream(client, chunks, file_size, file_name, part_size=PART_SIZE,
+                        buffer_parts=16, connections=1, parallel=1, progress_callback=None):
+    """
+    آپلود یک stream از bytes بدون ذخیره روی دیسک
+    - chunks: async iterator از bytes (مثلا بدنه پاسخ aiohttp)
+    - حجم فایل باید از قبل معلوم باشد (تعداد part ها برای تلگرام لازم است)
+    - حداکثر buffer_parts پارت در حافظه نگه داشته می‌شود (backpressure)
+    خروجی: InputFile / InputFileBig قابل استفاده در client.send_file
+    """
+    return await upload_ranges(
+        client, lambda start, end: chunks, file_size, file_name, [(0, file_size)],
+        part_size=part_size, buffer_parts=buffer_parts, connections=connections,
+        parallel=parallel, progress_callback=progress_callback
+    )
+
+
+async def upload_ranges(client, fetch_range, file_size, file_name, ranges, part_size=PART_SIZE,
+                        buffer_parts=16, connections=1, parallel=1, progress_callback=None):
+    """
+    آپلود stream چند بازه همزمان (مثلا چند اتصال Range به یک لینک)
+    - fetch_range(start, end): async iterator از bytes بازه [start, end)
+    - ranges: بازه‌های پشت سر هم که کل فایل را می‌پوشانند و شروعشان مضرب part_size است
+    - part های همه بازه‌ها در یک صف مشترک می‌روند؛ حداکثر buffer_parts پارت در حافظه
+    - فایل کوچک (md5 لازم دارد) همیشه با یک بازه و به ترتیب آپلود می‌شود
+    خروجی: InputFile / InputFileBig قابل استفاده در client.send_file
+    """
+    _check_part_size(part_size)
+    total_parts = math.ceil(file_size / part_size)
+    if total_parts > MAX_PARTS:
+        raise ValueError(f"File too large for Telegram: {file_size} bytes")
+
+    is_big = file_size > BIG_FILE_THRESHOLD
+    if not is_big:
+        ranges = [(0, file_size)]
+    if (
+        ranges[0][0] != 0 or ranges[-1][1] != file_size
+        or any(start % part_size for start, _ in ranges)
+        or any(prev[1] != cur[0] for prev, cur in zip(ranges, ranges[1:]))
+    ):
+        raise ValueError(f"Invalid upload ranges: {ranges}")
+
+    file_id = _new_file_id()
+    md5 = None if is_big else hashlib.md5()
+    # فایل کوچک باید به ترتیب آپلود شود تا md5 درست حساب شود
+    workers = max(1, parallel) if is_big else 1
+    parts = asyncio.Queue(maxsize=buffer_parts)
+    uploaded = 0
+
+    async def read_range(start, end):
+        buffer = bytearray()
+        index = start // part_size
+        received = 0
+        async for chunk in fetch_range(start, end):
+            received += len(chunk)
+            if received > end - start:
+                raise UploadSizeMismatch(f"Received more than {end - start} bytes at {start}")
+            buffer.extend(chunk)
+            while len(buffer) >= part_size:
+                part = bytes(buffer[:part_size])
+                del buffer[:part_size]
+                await parts.put((index, part))
+                index += 1
+
+        if received != end - start:
+            raise UploadSizeMismatch(f"Expected {end - start} bytes at {start}, got {received}")
+        if buffer:
+            await parts.put((index, bytes(buffer)))
+
+    async def read_parts():
+        await _run_all([read_range(start, end) for start, end in ranges])
+        for _ in range(workers):
+            await parts.put(None)
+
+    async def send_parts(slot, senders):
+        nonlocal uploaded
+        while True:
+            item = await parts.get()
+            if item is None:
+                return
+
+            index, part = item
+            if md5:
+                md5.update(part)
+            request = _part_request(file_id, index, total_parts, part, is_big)
+            await _send_part(senders, request, slot)
+
+            uploaded += len(part)
+            if progress_callback:
+                await progress_callback(uploaded, file_size)
+
+    async with SenderPool(client, connections if is_big else 1) as senders:
+        await _run_all([read_parts()] + [send_parts(slot, senders) for slot in range(workers)])
+
+    return _input_file(file_id, total_parts, file_name, is_big, md5)
+
+
+async def _run_all(coroutines):
+    """اجرای همزمان؛ با اولین خطا بقیه لغو می‌شوند"""
+    tasks = [asyncio.create_task(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def media_handle(message):
+    """شناسه، access hash و file reference سند یک پیام (برای ارسال دوباره بدون get_messages)"""
+    document = getattr(getattr(message, 'media', None), 'document', None)
+    if not document:
+        return None
+    return {
+        'doc_id': document.id,
+        'access_hash': document.access_hash,
+        'file_reference': document.file_reference
+    }
+
+
+def input_media(handle):
+    return InputMediaDocument(InputDocument(
+        id=handle['doc_id'],
+        access_hash=handle['access_hash'],
+        file_reference=handle['file_reference']
+    ))
@@ -1,13 +1,20 @@
 import os
 import re
+import json
+import shutil
 import asyncio
 import aiohttp
-import subprocess
-from pathlib import Path
 from telethon import TelegramClient, events, utils
+from telethon.errors import FileReferenceExpiredError, FileReferenceInvalidError
 from telethon.tl.types import DocumentAttributeVideo, DocumentAttributeFilename
-from database import file_cache, user_history
+from database import decode_media, file_cache, user_history
 from config import API_ID, API_HASH, BOT_TOKEN, BACKUP_CHANNEL_ID, DOWNLOAD_PATH
+from media_probe import ProbeService
+from telegram_upload import input_media, media_handle, upload_file
+
+# آپلود موازی part ها
+UPLOAD_CONNECTIONS = int(os.getenv('UPLOAD_CONNECTIONS', '4'))
+UPLOAD_PARALLEL = int(os.getenv('UPLOAD_PARALLEL', '8'))
 
 # کلاینت تلگرام
 client = None
@@ -22,6 +29,18 @@ def format_bytes(size):
         size /= 1024.0
     return f"{size:.2f} TB"
 
+# callback پیشرفت که هر چند ثانیه پیام وضعیت رو ادیت میکنه
+def make_progress(chat_id, message_id, title):
+    last_update = 0
+    async def report(done, total):
+        nonlocal last_update
+        now = asyncio.get_event_loop().time()
+        if total and now - last_update > 4:
+            last_update = now
+            try: await client.edit_message(chat_id, message_id, f"{title}\n📊 {done * 100 / total:.1f}%")
+            except: pass
+    return report
+
 def parse_custom_filename(text):
     # این تابع الان بیشتر نقش تایید کننده رو داره چون فرانت هندل میکنه
     # ولی برای اطمینان نگهش میداریم
@@ -64,44 +83,41 @@ async def cancel_download(job_id):
             return True
         return False
 
-# گرفتن اطلاعات ویدیو
-def get_video_info(filepath):
-    try:
-        cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams', '-show_format', filepath]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        import json
-        data = json.loads(result.stdout)
-        video = next((s for s in data.get('streams', []) if s['codec_type'] == 'video'), None)
-        if video:
-            return {
-                'width': int(video.get('width', 0)),
-                'height': int(video.get('height', 0)),
-                'duration': int(float(data.get('format', {}).get('duration', 0)))
-            }
-    except: pass
-    return {'width': 0, 'height': 0, 'duration': 0}
+# گرفتن اطلاعات ویدیو (ffprobe غیرهمزمان، حداکثر 2 تا همزمان، با کش)
+probe_service = ProbeService(asyncio.Semaphore(int(os.getenv('PROBE_SLOTS', '2'))))
+
+async def get_video_info(filepath):
+    return await probe_service.probe(filepath)
+
+# پوشه اختصاصی هر job
+def job_download_dir(job_id):
+    return os.path.join(DOWNLOAD_PATH, str(job_id))
 
 # دانلود با yt-dlp
-async def download_with_ytdlp(url, chat_id, message_id, cancel_event, custom_filename=None):
+async def download_with_ytdlp(url, chat_id, message_id, cancel_event, custom_filename=None, download_dir=DOWNLOAD_PATH):
     await start_client()
     await client.edit_message(chat_id, message_id, "🔥 در حال دانلود از سرور اصلی...")
     
-    os.makedirs(DOWNLOAD_PATH, exist_ok=True)
+    os.makedirs(download_dir, exist_ok=True)
     
     # تنظیم نام فایل خروجی
     if custom_filename:
         # مطمئن شو اکستنشن داره، اگه نداشت mp4 پیش فرض بذار یا بذار yt-dlp تصمیم بگیره
         if '.' not in custom_filename:
-             out_tmpl = os.path.join(DOWNLOAD_PATH, f"{custom_filename}.%(ext)s")
+             out_tmpl = os.path.join(download_dir, f"{custom_filename}.%(ext)s")
         else:
-             out_tmpl = os.path.join(DOWNLOAD_PATH, custom_filename)
+             out_tmpl = os.path.join(download_dir, custom_filename)
     else:
-        out_tmpl = os.path.join(DOWNLOAD_PATH, '%(title)s.%(ext)s')
+        out_tmpl = os.path.join(download_dir, '%(title)s.%(ext)s')
 
     # کانفیگ yt-dlp
     cmd = [
         'yt-dlp',
         '--output', out_tmpl,
+        # مسیر دقیق فایل نهایی به صورت JSON در stdout
+        '--print', 'after_move:%(.{filepath,width,height,duration})j',
+        '--progress',
+        '--newline',
         '--no-playlist',
         '--max-filesize', '2000M',
         '--no-check-certificate',
@@ -146,7 +162,7 @@ async def download_with_ytdlp(url, chat_id, message_id, cancel_event, custom_fil
                 # فعلا برای شلوغ نشدن کد نمیذارم
                 pass
 
-    await asyncio.gather(log_output(process.stdout), log_output(process.stderr))
+    stdout, _ = await asyncio.gather(process.stdout.read(), log_output(process.stderr))
     await process.wait()
 
     if cancel_event.is_set():
@@ -155,17 +171,22 @@ async def download_with_ytdlp(url, chat_id, message_id, cancel_event, custom_fil
     if process.returncode != 0:
         raise Exception("خطا در دانلود فایل. (ممکن است لینک خراب یا فیلتر باشد)")
 
-    # پیدا کردن فایل دانلود شده (چون نام دقیق رو شاید ندونیم)
-    # جدیدترین فایل در پوشه دانلود رو برمیگردونیم
-    list_of_files = list(Path(DOWNLOAD_PATH).glob('*'))
-    if not list_of_files:
-        raise Exception("فایلی دانلود نشد.")
-        
-    latest_file = max(list_of_files, key=os.path.getctime)
-    return str(latest_file)
+    # مسیر فایل رو خود yt-dlp در stdout چاپ میکنه
+    for line in reversed(stdout.decode('utf-8', errors='ignore').splitlines()):
+        try:
+            info = json.loads(line)
+            filepath = info.get('filepath')
+        except (ValueError, AttributeError):
+            continue
+        if filepath and os.path.exists(filepath):
+            # ابعاد و مدتی که yt-dlp میدونه جای ffprobe رو میگیره
+            probe_service.remember(filepath, info)
+            return filepath
+
+    raise Exception("فایلی دانلود نشد.")
 
 # آپلود به کانال بک‌آپ (برای کش)
-async def upload_to_backup(filepath, video_info=None):
+async def upload_to_backup(filepath, input_file, video_info=None):
     if not BACKUP_CHANNEL_ID: return None
     
     try:
@@ -185,20 +206,33 @@ async def upload_to_backup(filepath, video_info=None):
 
         msg = await client.send_file(
             BACKUP_CHANNEL_ID,
-            filepath,
+            input_file,
             caption=f"📦 {filename}\n💾 {format_bytes(os.path.getsize(filepath))}",
             attributes=attrs,
             force_document=False
         )
-        return msg.id
+        return msg
     except Exception as e:
         print(f"Backup Error: {e}")
         return None
 
 # تابع اصلی: ارسال بدون نقل قول
-async def send_cached_file(chat_id, file_id, caption, message_id):
+async def send_cached_file(chat_id, file_id, caption, message_id, media=None, url=None):
     try:
         await start_client()
+        # اگر handle سند را داریم مستقیم می‌فرستیم (بدون get_messages)
+        if media:
+            try:
+                await client.send_file(
+                    chat_id,
+                    input_media(media),
+                    caption=caption,
+                    reply_to=message_id
+                )
+                return True
+            except (FileReferenceExpiredError, FileReferenceInvalidError):
+                print(f"File reference expired for {file_id}, refreshing")
+        
         # دریافت پیام از کانال بک‌آپ
         # این کار باعث میشه مدیا رو بگیریم ولی فوروارد نکنیم (Clean Send)
         msgs = await client.get_messages(BACKUP_CHANNEL_ID, ids=[int(file_id)])
@@ -206,6 +240,8 @@ async def send_cached_file(chat_id, file_id, caption, message_id):
             return False
             
         target_msg = msgs[0]
+        if url and media_handle(target_msg):
+            await file_cache.update_media(url, media_handle(target_msg))
         
         # ارسال فایل به کاربر
         await client.send_file(
@@ -233,6 +269,7 @@ async def process_download_job(job_data):
     
     cancel_event = await create_cancel_token(job_id)
     filepath = None
+    download_dir = job_download_dir(job_id)
     
     try:
         await start_client()
@@ -247,7 +284,10 @@ async def process_download_job(job_data):
             await client.edit_message(chat_id, message_id, "♻️ یافتن فایل در کش...")
             caption = f"✅ **{cached['file_name']}**\n💾 {format_bytes(cached['file_size'])}\n⚡️ (از آرشیو)"
             
-            sent = await send_cached_file(chat_id, cached['file_id'], caption, message_id)
+            sent = await send_cached_file(
+                chat_id, cached['file_id'], caption, message_id,
+                media=decode_media(cached.get('media')), url=url
+            )
             if sent:
                 # ثبت در تاریخچه کاربر
                 await user_history.add(user_id, url, cached['file_name'], cached['file_size'])
@@ -257,7 +297,7 @@ async def process_download_job(job_data):
                 print("Cache hit but failed to send. Redownloading...")
 
         # 2. شروع دانلود
-        filepath = await download_with_ytdlp(url, chat_id, message_id, cancel_event, custom_name)
+        filepath = await download_with_ytdlp(url, chat_id, message_id, cancel_event, custom_name, download_dir)
         
         file_size = os.path.getsize(filepath)
         filename = os.path.basename(filepath)
@@ -265,16 +305,25 @@ async def process_download_job(job_data):
         # 3. دریافت اطلاعات ویدیو (اگر ویدیو بود)
         video_info = {'width': 0, 'height': 0, 'duration': 0}
         if filename.endswith(('.mp4', '.mkv', '.webm', '.mov')):
-             video_info = get_video_info(filepath)
+             video_info = await get_video_info(filepath)
 
         await client.edit_message(chat_id, message_id, "📤 در حال آپلود به تلگرام...")
 
-        # 4. آپلود به کانال بک‌آپ (برای کش کردن)
-        backup_msg_id = await upload_to_backup(filepath, video_info)
+        # 4. آپلود فایل (فقط یک بار) و ارسال به کانال بک‌آپ (برای کش کردن)
+        upload_progress = make_progress(chat_id, message_id, "📤 در حال آپلود به تلگرام...")
+        input_file = await upload_file(
+            client, filepath,
+            connections=UPLOAD_CONNECTIONS,
+            parallel=UPLOAD_PARALLEL,
+            progress_callback=upload_progress
+        )
+        backup_msg = await upload_to_backup(filepath, input_file, video_info)
+        backup_msg_id = backup_msg.id if backup_msg else None
+        backup_media = media_handle(backup_msg) if backup_msg else None
         
         # 5. کش کردن
         if backup_msg_id and not custom_name:
-            await file_cache.set(url, backup_msg_id, 'video', filename, file_size)
+            await file_cache.set(url, backup_msg_id, 'video', filename, file_size, backup_media)
 
         # 6. ارسال نهایی به کاربر (بدون نقل قول)
         # اگر تونستیم بک‌آپ بگیریم، از همون بک‌آپ برای کاربر میفرستیم (سریعتره)
@@ -282,9 +331,12 @@ async def process_download_job(job_data):
         final_caption = f"✅ **{filename}**\n💾 {format_bytes(file_size)}\n🤖 @YourBotID"
         
         if backup_msg_id:
-             sent_final = await send_cached_file(chat_id, backup_msg_id, final_caption, message_id)
+             sent_final = await send_cached_file(
+                 chat_id, backup_msg_id, final_caption, message_id, media=backup_media
+             )
         
-        # اگه از بک‌آپ نشد (یا بک‌آپ نداشتیم)، مستقیم فایل رو آپلود کن
+        # اگه از بک‌آپ نشد (یا بک‌آپ نداشتیم)، همون فایل آپلود شده رو مستقیم بفرست
+        # (media پیام بک‌آپ یا InputFile؛ هیچ وقت دوباره آپلود نمی‌کنیم)
         if not sent_final:
              attrs = []
              if video_info['duration']:
@@ -292,7 +344,7 @@ async def process_download_job(job_data):
                  
              await client.send_file(
                  chat_id, 
-                 filepath, 
+                 backup_msg.media if backup_msg else input_file, 
                  caption=final_caption, 
                  reply_to=message_id,
                  attributes=attrs
@@ -312,9 +364,8 @@ async def process_download_job(job_data):
         return {'status': 'error', 'error': str(e)}
         
     finally:
-        # پاک کردن فایل دانلود شده
-        if filepath and os.path.exists(filepath):
-            os.remove(filepath)
+        # پاک کردن پوشه job (همراه با .part و fragment ها)
+        shutil.rmtree(download_dir, ignore_errors=True)
         
         async with cancel_lock:
             if job_id in active_downloads:
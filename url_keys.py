@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# url_keys.py - کلید یکتای کش برای هر لینک (extractor + شناسه مدیا)
+
+import re
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlsplit
+
+# نسخه قانون‌های کلید؛ با هر تغییر قانون‌ها بالا می‌رود تا کش‌ها دوباره کلیدگذاری شوند
+KEY_VERSION = 1
+
+# پارامترهای ردیابی که روی فایل دانلود شده اثری ندارند
+_TRACKING_PARAMS = {
+    'fbclid', 'gclid', 'dclid', 'gbraid', 'wbraid', 'msclkid', 'yclid',
+    'igshid', 'mc_cid', 'mc_eid', '_ga', '_gl'
+}
+
+_YOUTUBE_ID = r'([A-Za-z0-9_-]{11})'
+
+# host → (extractor, [(regex روی path, گروه شناسه), ...], پارامتر query شامل شناسه)
+# برای هر host فقط قانون‌های همان سایت امتحان می‌شوند
+_RULES = {}
+
+
+def _rule(hosts, extractor, paths=(), query_param=None):
+    compiled = [re.compile(pattern) for pattern in paths]
+    for host in hosts:
+        _RULES[host] = (extractor, compiled, query_param)
+
+
+_rule(
+    ('youtube.com', 'm.youtube.com', 'music.youtube.com', 'youtube-nocookie.com'),
+    'youtube',
+    paths=(
+        rf'^/(?:shorts|embed|live|v)/{_YOUTUBE_ID}',
+    ),
+    query_param='v'
+)
+_rule(('youtu.be',), 'youtube', paths=(rf'^/{_YOUTUBE_ID}',))
+_rule(
+    ('soundcloud.com', 'm.soundcloud.com'),
+    'soundcloud',
+    paths=(r'^/([^/]+/(?!sets/)[^/]+)/?$', r'^/([^/]+/sets/[^/]+)/?$')
+)
+_rule(('pornhub.com', 'pornhub.org'), 'pornhub', query_param='viewkey')
+_rule(('xvideos.com',), 'xvideos', paths=(r'^/video\.?([0-9a-z]+)/',))
+_rule(('xnxx.com',), 'xnxx', paths=(r'^/video-([0-9a-z]+)/',))
+
+
+def _host(netloc):
+    host = netloc.lower().rsplit('@', 1)[-1].split(':', 1)[0]
+    if host.startswith('www.'):
+        host = host[4:]
+    return host
+
+
+def _match(host):
+    # زیردامنه‌های زبان مثل de.pornhub.com
+    while host:
+        if host in _RULES:
+            return _RULES[host]
+        if '.' not in host:
+            return None
+        host = host.split('.', 1)[1]
+    return None
+
+
+def _query(query):
+    """query مرتب شده بدون پارامترهای ردیابی (شناسه فایل اغلب در query است: uc?id=...)"""
+    params = [
+        (name, value) for name, value in parse_qsl(query, keep_blank_values=True)
+        if name not in _TRACKING_PARAMS and not name.startswith('utm_')
+    ]
+    return urlencode(sorted(params))
+
+
+def canonical_key(url):
+    """
+    کلید کش یک لینک
+    - لینک‌های شناخته شده: 'youtube:dQw4w9WgXcQ'، 'soundcloud:artist/track'، ...
+    - بقیه: 'url:host/path?query' (query مرتب و بدون پارامترهای ردیابی، بدون fragment)
+      مثلا drive.google.com/uc?id=AAA و ?id=BBB دو کلید جدا دارند
+    """
+    url = url.strip()
+    try:
+        parts = urlsplit(url if '://' in url else f'https://{url}')
+    except ValueError:
+        return f'url:{url}'
+    host = _host(parts.netloc)
+
+    rule = _match(host)
+    if rule:
+        extractor, paths, query_param = rule
+        if query_param:
+            values = parse_qs(parts.query).get(query_param)
+            if values and values[0]:
+                return f'{extractor}:{values[0]}'
+        for pattern in paths:
+            found = pattern.match(parts.path)
+            if found:
+                return f'{extractor}:{found.group(1)}'
+
+    netloc = parts.netloc.lower().rsplit('@', 1)[-1]
+    if netloc.startswith('www.'):
+        netloc = netloc[4:]
+    key = f'url:{netloc}{parts.path.rstrip("/") or "/"}'
+    query = _query(parts.query)
+    return f'{key}?{query}' if query else key
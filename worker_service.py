@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# worker_service.py - پردازش job ها از صف پایدار مشترک (جدا از api_server.py)
+#
+# هر پروسه WORKER_COUNT worker دارد؛ برای ظرفیت بیشتر پروسه‌های بیشتری با
+# WORKER_PORT و TELEGRAM_SESSION جدا اجرا کنید (start.sh با WORKER_PROCESSES).
+# HTTP این سرویس داخلی است: /wake (بیدار کردن بعد از ثبت job)، /health و /metrics
+
+import os
+
+from fastapi import FastAPI
+
+import backend
+
+app = FastAPI()
+
+
+@app.on_event("startup")
+async def startup_event():
+    await backend.start_worker_service()
+
+
+@app.post("/wake")
+async def wake():
+    backend.job_available.set()
+    return {'ok': True}
+
+
+@app.get("/health")
+async def health_check():
+    return {
+        "status": "ok",
+        "worker": backend.WORKER_NAME,
+        "telegram": backend.client_pool.is_connected(),
+        "workers_alive": sum(1 for task in backend.worker_tasks if not task.done()),
+        "active_jobs": len(backend.active_jobs)
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    # مرحله‌ها، دیسک و flood wait همین پروسه
+    return await backend.get_metrics()
+
+
+if __name__ == '__main__':
+    import uvicorn
+    port = int(os.getenv('WORKER_PORT', 9000))
+    uvicorn.run(app, host='0.0.0.0', port=port)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# ytdlp_pool.py - process های yt-dlp همیشه آماده (بدون import و خواندن cookies برای هر job)
+#
+# پروتکل: هر پیام یک خط JSON
+#   backend → worker (stdin):  {"op": "download" | "extract", "url": ..., "options": {...}, "info": {...}?}
+#   worker → backend (stdout): {"event": "ready"}، {"event": "progress", "downloaded", "total"}،
+#                              {"event": "done", "info", "rss"} یا {"event": "error", "message", "rss"}
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+SPAWN_TIMEOUT = 60
+PROGRESS_INTERVAL = 0.5
+# info JSON پیام‌ها (لیست فرمت‌ها) از محدودیت 64KB پیش‌فرض StreamReader بزرگتر است
+PIPE_LIMIT = 32 * 1024 * 1024
+# کلیدهای حجیم info که برای دانلود دوباره لازم نیستند
+BULKY_INFO_KEYS = ('automatic_captions', 'subtitles', 'heatmap', 'thumbnails', 'chapters')
+
+
+def compact_info(info):
+    """info استخراج شده بدون بخش‌های حجیم (برای کش و ارسال دوباره به yt-dlp)"""
+    return {key: value for key, value in info.items() if key not in BULKY_INFO_KEYS}
+
+
+def info_size(info):
+    """حجم خروجی فرمت انتخاب شده؛ فرمت‌های ترکیبی (ویدیو + صدا) حجم را فقط در requested_formats دارند"""
+    if not info:
+        return None
+    formats = info.get('requested_formats') or [info]
+    sizes = [fmt.get('filesize') or fmt.get('filesize_approx') for fmt in formats]
+    return int(sum(sizes)) if all(sizes) else None
+
+
+class YtdlpError(Exception):
+    """شکست yt-dlp (خروج غیر صفر CLI یا خطای داخل worker)"""
+
+    def __init__(self, message, code='error'):
+        super().__init__(message)
+        self.code = code
+
+
+class _Worker:
+    def __init__(self, process):
+        self.process = process
+        self.jobs = 0
+
+
+class YtdlpPool:
+    """
+    چند process yt-dlp که yt_dlp را یک بار import و cookies.txt را یک بار می‌خوانند
+    - هر worker در هر لحظه یک job دارد؛ پیشرفت دانلود خط به خط برمی‌گردد
+    - worker بعد از max_jobs job یا وقتی حافظه‌اش از max_rss بیشتر شود عوض می‌شود
+    - با لغو job، worker همان لحظه kill می‌شود (دانلود yt-dlp وسط کار قابل توقف نیست)
+    - extract ظرفیت جدا (extract_size) دارد تا پشت دانلودهای طولانی منتظر نماند
+    """
+
+    def __init__(self, size, cookie_path=None, max_jobs=50, max_rss=512 * 1024 * 1024, extract_size=1):
+        self.size = max(1, size)
+        self.extract_size = max(1, extract_size)
+        self.cookie_path = cookie_path
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.spawned = 0
+        self.recycled = 0
+        self._idle = []
+        self._slots = {
+            'download': asyncio.Semaphore(self.size),
+            'extract': asyncio.Semaphore(self.extract_size)
+        }
+
+    async def start(self):
+        """گرم کردن worker ها قبل از اولین job"""
+        results = await asyncio.gather(
+            *(self._spawn() for _ in range(self.size + self.extract_size - len(self._idle))),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"yt-dlp worker failed to start: {result}")
+            else:
+                self._release(result)
+        logger.info(f"🎬 yt-dlp pool ready ({len(self._idle)} workers)")
+
+    async def _spawn(self):
+        args = [sys.executable, os.path.abspath(__file__)]
+        if self.cookie_path:
+            args.extend(['--cookies', self.cookie_path])
+
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            limit=PIPE_LIMIT
+        )
+        try:
+            line = await asyncio.wait_for(process.stdout.readline(), SPAWN_TIMEOUT)
+            if json.loads(line or b'{}').get('event') != 'ready':
+                raise YtdlpError(f"yt-dlp worker {process.pid} did not start")
+        except BaseException:
+            process.kill()
+            raise
+
+        self.spawned += 1
+        return _Worker(process)
+
+    def _release(self, worker):
+        # job هایی که قبل از تمام شدن start() آمده‌اند worker خودشان را ساخته‌اند؛
+        # بیشتر از ظرفیت دو نوع job worker بیکار نگه داشته نمی‌شود
+        if len(self._idle) >= self.size + self.extract_size:
+            self._retire(worker, graceful=True)
+        else:
+            self._idle.append(worker)
+
+    def _retire(self, worker, graceful):
+        process = worker.process
+        if process.returncode is not None:
+            return
+        try:
+            if graceful:
+                # بستن stdin = خروج عادی worker بعد از job فعلی
+                process.stdin.close()
+                self.recycled += 1
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass
+
+    async def run(self, op, url, options, on_progress=None, info=None, timeout=None):
+        """
+        اجرای یک job روی worker آزاد
+        - extract: info کامل بدون دانلود
+        - download: اگر info (از کش) داده شود استخراج دوباره انجام نمی‌شود
+        - timeout از زمان گرفتن worker حساب می‌شود، نه از انتظار برای ظرفیت
+        خروجی: info (برای download فقط مسیر فایل، ابعاد و مدت)
+        """
+        async with self._slots[op]:
+            worker = self._idle.pop() if self._idle else await self._spawn()
+            finished = False
+            reusable = False
+            try:
+                request = json.dumps({'op': op, 'url': url, 'options': options, 'info': info})
+                message = await asyncio.wait_for(self._exchange(worker, request, on_progress), timeout)
+
+                finished = True
+                worker.jobs += 1
+                reusable = worker.jobs < self.max_jobs and message.get('rss', 0) < self.max_rss
+                if message['event'] == 'error':
+                    raise YtdlpError(message['message'])
+                return message['info']
+            finally:
+                if reusable:
+                    self._release(worker)
+                else:
+                    self._retire(worker, graceful=finished)
+
+    async def _exchange(self, worker, request, on_progress):
+        """ارسال درخواست و خواندن پیام‌ها تا نتیجه نهایی (done یا error)"""
+        worker.process.stdin.write(request.encode() + b'\n')
+        await worker.process.stdin.drain()
+
+        while True:
+            line = await worker.process.stdout.readline()
+            if not line:
+                raise YtdlpError(f"yt-dlp worker {worker.process.pid} exited unexpectedly")
+
+            message = json.loads(line)
+            if message['event'] != 'progress':
+                return message
+            if on_progress:
+                await on_progress(message['downloaded'], message['total'])
+
+    def snapshot(self):
+        return {
+            'size': self.size,
+            'extract_size': self.extract_size,
+            'idle': len(self._idle),
+            'spawned': self.spawned,
+            'recycled': self.recycled
+        }
+
+
+# ===========================
+# Worker process
+# ===========================
+def _rss():
+    """حافظه فعلی process (بایت)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _run_request(yt_dlp, cookiejar, request, send):
+    op = request['op']
+    params = dict(request['options'])
+    params.update(quiet=True, no_warnings=True, noprogress=True, no_color=True)
+
+    if op == 'download':
+        last_report = 0
+
+        def progress_hook(status):
+            nonlocal last_report
+            now = time.monotonic()
+            if status['status'] == 'downloading' and now - last_report >= PROGRESS_INTERVAL:
+                last_report = now
+                send(
+                    event='progress',
+                    downloaded=status.get('downloaded_bytes') or 0,
+                    total=status.get('total_bytes') or status.get('total_bytes_estimate') or 0
+                )
+
+        params['progress_hooks'] = [progress_hook]
+
+    with yt_dlp.YoutubeDL(params) as ydl:
+        if cookiejar is not None:
+            # cookiejar یک cached_property است؛ jar از قبل خوانده شده دوباره parse نمی‌شود
+            ydl.cookiejar = cookiejar
+
+        info = None
+        if op == 'download' and request.get('info'):
+            try:
+                # مثل --load-info-json: دانلود از info کش شده بدون استخراج صفحه
+                info = ydl.process_ie_result(request['info'], download=True)
+            except yt_dlp.utils.DownloadError as e:
+                # لینک فرمت‌ها در info کش شده منقضی شده؛ استخراج دوباره
+                print(f"Cached info failed, re-extracting: {e}", file=sys.stderr)
+        if info is None:
+            info = ydl.extract_info(request['url'], download=(op == 'download'))
+        info = ydl.sanitize_info(info)
+
+    if op == 'extract':
+        return compact_info(info)
+
+    downloads = info.get('requested_downloads') or [{}]
+    return {
+        'filepath': downloads[0].get('filepath') or info.get('filepath'),
+        'ext': info.get('ext'),
+        'title': info.get('title'),
+        'width': info.get('width'),
+        'height': info.get('height'),
+        'duration': info.get('duration')
+    }
+
+
+def serve(cookie_path=None):
+    """حلقه worker: خواندن job از stdin و نوشتن نتیجه روی stdout"""
+    # stdout فقط مال پروتکل است؛ هر چیزی که yt-dlp چاپ کند به stderr می‌رود
+    channel = os.fdopen(os.dup(1), 'w', buffering=1)
+    os.dup2(2, 1)
+
+    def send(**message):
+        channel.write(json.dumps(message) + '\n')
+
+    import yt_dlp
+    from yt_dlp.cookies import load_cookies
+
+    cookiejar = None
+    if cookie_path and os.path.exists(cookie_path):
+        cookiejar = load_cookies(cookie_path, None, None)
+
+    send(event='ready')
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            info = _run_request(yt_dlp, cookiejar, json.loads(line), send)
+            send(event='done', info=info, rss=_rss())
+        except Exception as e:
+            send(event='error', message=str(e)[-500:], rss=_rss())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='yt-dlp pool worker')
+    parser.add_argument('--cookies')
+    serve(parser.parse_args().cookies)